@@ -3,18 +3,22 @@
 import logging
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from time import time
-from urllib.parse import quote
+from time import time, perf_counter
 
-from callinfo import CallInfo, CallInfoType, UNKNOWN_NAME
-from callmonitor import CallMonitor, CallMonitorType, CallMonitorLine, CallMonitorLog
+from callinfo import CallInfo, CallInfoType, UNKNOWN_NAME, CACHE_TELLOWS, get_default_caches
+from callmonitor import CallMonitor, CallMonitorType, CallMonitorLine, CallMonitorLog, close_logger
 from callprefix import CallPrefix
 from fritzconn import FritzConn
+from metrics import registry
+from notifier import Notifier
 from phonebook import Phonebook
+from tracing import tracer, traced
 
 sys.path.append(os.path.dirname(__file__))
-from utils import Log, anonymize_number
+from utils import Log, DigitTrie, anonymize_number
 
 sys.path.append("..")
 try:
@@ -22,14 +26,16 @@ try:
 except ImportError:
     TELEGRAM_BOT_URL = ""
 
-import requests
-
 
 logging.basicConfig(level=logging.WARNING)
 log = logging.getLogger(__name__)
 
 FAKE_PREFIX = 'FAKE_PREFIX'  # E.g. prefix 09460 does not exist in Germany, regarding to ONB
 
+VERDICTS = registry.counter('a1fbox_callblocker_verdicts_total', 'Call blocker lines, by rate', ['rate'])
+DECISION_SECONDS = registry.histogram('a1fbox_callblocker_decision_seconds',
+                                      'Time to decide on a call, by phase (sync, local, enriched)', ['phase'])
+
 
 class CallBlockerRate(Enum):
     """ Custom blocker rates. Currently method is sufficient to distinguish rated entries. """
@@ -62,7 +68,8 @@ class CallBlockerLine:
         self.date, self.time = self.datetime.split(' ')
         if int(self.method) in [CallInfoType.WEMGEHOERT_SCORE.value]:
             self.score = more[0]
-        elif int(self.method) in [CallInfoType.TELLOWS_SCORE.value, CallInfoType.CASCADE.value]:
+        elif int(self.method) in [CallInfoType.TELLOWS_SCORE.value, CallInfoType.CASCADE.value,
+                                  CallInfoType.ENRICHED.value]:
             self.score, self.comments, self.searches = more[0], more[1], more[2]
 
     def __str__(self):
@@ -71,7 +78,8 @@ class CallBlockerLine:
         start = f'date:{self.date} time:{self.time} rate:{self.rate} caller:{self.caller} name:{self.name}'
         if int(self.method) in [CallInfoType.WEMGEHOERT_SCORE.value]:
             return f'{start} score:{self.score}'
-        elif int(self.method) in [CallInfoType.TELLOWS_SCORE.value, CallInfoType.CASCADE.value]:
+        elif int(self.method) in [CallInfoType.TELLOWS_SCORE.value, CallInfoType.CASCADE.value,
+                                  CallInfoType.ENRICHED.value]:
             return f'{start} score:{self.score} comments:{self.comments} searches:{self.searches}'
         else:
             return start
@@ -80,16 +88,175 @@ class CallBlockerLine:
 class CallBlockerLog(Log):
     """ Call blocker lines are logged to a file. So far call blocker uses method log_line only. """
 
-    def __init__(self, file_prefix="callblocker", log_folder=None, daily=False, anonymize=False):
-        super().__init__(file_prefix, log_folder, daily, anonymize)
+    def __init__(self, file_prefix="callblocker", log_folder=None, daily=False, anonymize=False, **kwargs):
+        super().__init__(file_prefix, log_folder, daily, anonymize, **kwargs)
 
     def log_line(self, line):
         """ Append a line to the log file. """
-        filepath = self.get_log_filepath()
         if self.do_anon:
             line = CallBlockerLine.anonymize(line)
-        with open(filepath, "a", encoding='utf-8') as f:
-            f.write(line)
+        self.write_line(line)
+
+    def query(self, start, end):
+        """ Yield parsed CallBlockerLines logged within [start, end), e.g. from compressed daily archives. """
+        for raw_line in self.query_raw_lines(start, end):
+            yield CallBlockerLine(raw_line)
+
+
+class CallBlockerCall:
+    """ State of one examined call, passed through the rules of the pipeline. """
+
+    def __init__(self, cb, cm_line, number, full_number):
+        self.cb = cb
+        self.cm_line, self.number, self.full_number = cm_line, number, full_number
+        self.canonical = cb.cp.normalizer(number)  # Key of white- and blacklist
+        self.name = None  # E.g. name of the phonebook entry
+        self.ci = None  # CallInfo, created by the first rule asking for it
+        self.method = CallInfoType.INIT.value
+        self.prefix_looked_up, self._prefix_name = False, None
+
+    @property
+    def prefix_name(self):
+        """ Prefix is looked up on first use only. """
+        if not self.prefix_looked_up:
+            self._prefix_name = self.cb.get_prefix_name(self.number, self.full_number)
+            self.prefix_looked_up = True
+        return self._prefix_name
+
+    def get_ci(self):
+        if not self.ci:
+            self.ci = CallInfo(self.full_number, caches=self.cb.caches)
+        return self.ci
+
+    def get_name(self):
+        """ If there is no other information name at least the country or area. """
+        if self.name:
+            return self.name
+        if self.ci and self.ci.name != UNKNOWN_NAME:
+            return self.ci.name
+        return str(self.prefix_name)
+
+    def get_line(self, rate):
+        """ Adapt to logging style of call monitor, scores are added if a score was used. """
+        start = f'{self.cm_line.datetime};{rate};{self.method};{self.full_number};"{self.get_name()}";'
+        if self.method == CallInfoType.INIT.value:
+            return start + "\n"
+        return start + f'{self.ci.score};{self.ci.comments};{self.ci.searches};' + "\n"
+
+
+class CallBlockerRule:
+    """ A rule of the call blocker's pipeline. examine returns a CallBlockerRate value to decide, which stops the
+    pipeline, or None to leave it to the next rules. Local rules use data in memory only, online rules can take
+    seconds. Each rule counts its invocations, decisions and the time spent. """
+
+    local = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls, self.decisions, self.seconds = 0, 0, 0.0
+
+    def __call__(self, call):
+        start = perf_counter()
+        rate = None
+        try:
+            with tracer.span('callblocker.rule', rule=type(self).__name__):
+                rate = self.examine(call)
+            return rate
+        finally:
+            with self.lock:
+                self.calls += 1
+                self.decisions += 1 if rate else 0
+                self.seconds += perf_counter() - start
+
+    def examine(self, call):
+        raise NotImplementedError()
+
+    def get_stats(self):
+        return {'rule': type(self).__name__, 'local': self.local, 'calls': self.calls, 'decisions': self.decisions,
+                'seconds': round(self.seconds, 6),
+                'avg_ms': round(1000 * self.seconds / self.calls, 3) if self.calls else 0}
+
+
+class ListsRule(CallBlockerRule):
+    """ Is the number in the white- or blacklist? Both are keyed by the canonical number, so either full number
+    071..123... or short number 123... or +49 71..123... are found by one probe. """
+
+    def examine(self, call):
+        cb = call.cb
+        name_white = cb.whitelist.get(call.canonical)
+        name_black = cb.blacklist.get(call.canonical)
+
+        if name_white and name_black:
+            raise Exception(f'Problem in your phonebooks detected: '
+                            f'a number should not be on white- and blacklist. Please fix! Details: '
+                            f'whitelist:{name_white} blacklist:{name_black}')
+
+        if name_white or name_black:
+            call.name = name_black if name_black else name_white  # Reason: black might win over white by blocking it
+            return CallBlockerRate.BLACKLIST.value if name_black else CallBlockerRate.WHITELIST.value
+        return None
+
+
+class PrefixListsRule(CallBlockerRule):
+    """ Does the number start with a prefix of the white- or blacklist, like 0039* or 069660*? Both are tries of
+    canonical prefixes, so the check is O(length of number). If both match, the longer prefix wins. """
+
+    def examine(self, call):
+        white = call.cb.white_prefixes.get_longest_match(call.canonical)
+        black = call.cb.black_prefixes.get_longest_match(call.canonical)
+        if black and (not white or len(black[0]) >= len(white[0])):
+            call.name = black[1]
+            return CallBlockerRate.BLACKLIST.value
+        if white:
+            call.name = white[1]
+            return CallBlockerRate.WHITELIST.value
+        return None
+
+
+class IllegalPrefixRule(CallBlockerRule):
+    """ Block if the prefix (Vorwahl) does not exist, see CallBlocker.get_prefix_name. """
+
+    def examine(self, call):
+        if call.cb.block_illegal_prefix and call.prefix_name == FAKE_PREFIX:
+            return CallBlockerRate.BLOCK.value
+        return None
+
+
+class AbroadRule(CallBlockerRule):
+    """ Block calls from abroad if wanted. """
+
+    def examine(self, call):
+        is_abroad = call.number.startswith('00') and not call.number.startswith(call.cb.cp.country_code)
+        if call.cb.block_abroad and is_abroad:
+            return CallBlockerRate.BLOCK.value
+        return None
+
+
+class CachedScoreRule(CallBlockerRule):
+    """ Block by a Tellows score found in the caches, without going online. """
+
+    def examine(self, call):
+        if not call.cb.caches:
+            return None
+        ci = call.get_ci()
+        info = ci.get_cached(CACHE_TELLOWS)  # Kept by the CallInfo, the online score does not look up again
+        if not info:
+            return None
+        ci.set_tellows_info(info)
+        call.method = CallInfoType.TELLOWS_SCORE.value
+        return CallBlockerRate.BLOCK.value if call.cb.is_bad_score(ci) else None
+
+
+class OnlineScoreRule(CallBlockerRule):
+    """ Block by the online cascade score, the expensive one. """
+
+    local = False
+
+    def examine(self, call):
+        ci = call.get_ci()
+        ci.get_cascade_score(deadline_sec=call.cb.cascade_deadline_sec)
+        call.method = CallInfoType.TELLOWS_SCORE.value
+        return CallBlockerRate.BLOCK.value if call.cb.is_bad_score(ci) else None
 
 
 class CallBlocker:
@@ -99,10 +266,23 @@ class CallBlocker:
                  whitelist_pbids, blacklist_pbids, blocklist_pbid, blockname_prefix='',
                  min_score=6, min_comments=3,
                  block_abroad=False, block_illegal_prefix=True,
-                 logger=None):
-        """ Provide a whitelist phonebook (normally first index 0) and where blocked numbers should go into. """
+                 logger=None, caches=None, cascade_deadline_sec=None, two_phase=False, refresh_sec=3600,
+                 rules=None, notifier=None, block_prefixes=None, allow_prefixes=None):
+        """ Provide a whitelist phonebook (normally first index 0) and where blocked numbers should go into.
+        The blocklist phonebook is always used as blacklist, too, even if not given within blacklist_pbids.
+        Optionally provide caches for the online lookups, see callinfo.get_default_caches. If a cascade deadline
+        is given, the online lookups run concurrently and are bounded by it, e.g. 0.8 seconds.
+        If two_phase is set, a verdict is logged at once from local data (phonebooks, prefix, abroad, cached scores),
+        the online enrichment runs in the background and logs a follow-up line with method ENRICHED.
+        Every refresh_sec the phonebooks are checked for changes, only changed ones are parsed again.
+        The decision is made by an ordered pipeline of rules, see get_default_rules. The first deciding rule wins.
+        Lines are posted by a notifier in the background, by default to TELEGRAM_BOT_URL if configured.
+        Numbers starting with block_prefixes or allow_prefixes (list of e.g. '0039*', or dict of prefix: name) are
+        black- or whitelisted. Phonebook entries with a trailing * are used as prefixes the same way. """
         self.whitelist_pbids = whitelist_pbids
-        self.blacklist_pbids = blacklist_pbids
+        # Blocked numbers are blacklisted in memory, so the blocklist has to be part of the blacklist on reloads, too
+        self.blacklist_pbids = blacklist_pbids if blocklist_pbid in blacklist_pbids \
+            else blacklist_pbids + [blocklist_pbid]
         self.blocklist_pbid = blocklist_pbid
         self.blockname_prefix = blockname_prefix
         self.min_score = int(min_score)
@@ -111,11 +291,26 @@ class CallBlocker:
         self.block_abroad = block_abroad
         self.block_illegal_prefix = block_illegal_prefix
         self.logger = logger
+        self.caches = caches
+        self.cascade_deadline_sec = cascade_deadline_sec
+        self.two_phase = two_phase
+        self.rules = rules if rules else self.get_default_rules()
+        if not notifier and TELEGRAM_BOT_URL:
+            notifier = Notifier(TELEGRAM_BOT_URL, prefix='CallBlocker: ')
+        self.notifier = notifier
+        self.enricher = ThreadPoolExecutor(max_workers=1) if two_phase else None
+        self.refresh_sec = refresh_sec
+        self.block_prefixes = block_prefixes if block_prefixes else dict()
+        self.allow_prefixes = allow_prefixes if allow_prefixes else dict()
+        self.pb_markers, self.pb_numbers = dict(), dict()  # Change marker and number-name-dict per phonebook id
+        self.lists_lock = threading.Lock()  # Reloading the lists vs. adding blocked numbers by the enricher
         print("Retrieving data from Fritz!Box..")
         self.pb = Phonebook(fc=fc)
         fritz_model = self.pb.fc.modelname
         fritz_os = self.pb.fc.system_version
         self.cp = CallPrefix(fc=self.pb.fc)
+        if self.caches is not None and self.caches.normalizer is None:
+            self.caches.normalizer = self.cp.normalizer  # Same entry for any notation of a number
         self.pb.ensure_pb_ids_valid(self.whitelist_pbids + self.blacklist_pbids + [self.blocklist_pbid])
         self.reload_phonebooks()
         if self.cp.country_code != '0049':
@@ -124,19 +319,52 @@ class CallBlocker:
               f'model:{fritz_model} ({fritz_os}) '
               f'country:{self.cp.country_code_name} ({self.cp.country_code}) '
               f'area:{self.cp.area_code_name} ({self.cp.area_code}) '
-              f'whitelisted:{len(self.whitelist)} blacklisted:{len(self.blacklist)} prefixes:{len(self.cp.prefix_dict)}')
-        if TELEGRAM_BOT_URL:
-            requests.get(TELEGRAM_BOT_URL + quote("CallBlocker: initialized"))
+              f'whitelisted:{len(self.whitelist)}+{len(self.white_prefixes)}* '
+              f'blacklisted:{len(self.blacklist)}+{len(self.black_prefixes)}* prefixes:{len(self.cp.prefix_dict)}')
+        if self.notifier:
+            self.notifier.notify("initialized")
 
+    @traced('callblocker.reload_phonebooks')
     def reload_phonebooks(self):
-        """ Whitelist should be reloaded e.g. every day, blacklist after each entry added. """
-        self.whitelist = self.pb.get_all_numbers_for_pb_ids(self.whitelist_pbids)
-        self.blacklist = self.pb.get_all_numbers_for_pb_ids(self.blacklist_pbids)
-        self.list_age = time()
+        """ Whitelist and blacklist are checked for changes e.g. every hour, a phonebook is only parsed again if its
+        change marker differs. Numbers blocked by us are added to the blacklist directly, see block_number.
+        The lists are replaced as a whole, so a lookup sees either the old or the new ones. """
+        with self.lists_lock:
+            changed = False
+            for pb_id in set(self.whitelist_pbids + self.blacklist_pbids):
+                marker, numbers = self.pb.get_all_numbers_if_changed(pb_id, self.pb_markers.get(pb_id))
+                if numbers is not None:
+                    self.pb_markers[pb_id], self.pb_numbers[pb_id] = marker, numbers
+                    changed = True
+            if changed:
+                self.whitelist, self.white_prefixes = self.get_numbers_for_pb_ids(self.whitelist_pbids,
+                                                                                  self.allow_prefixes)
+                self.blacklist, self.black_prefixes = self.get_numbers_for_pb_ids(self.blacklist_pbids,
+                                                                                  self.block_prefixes)
+            self.list_age = time()
+
+    def get_numbers_for_pb_ids(self, pb_ids, prefixes):
+        """ Concatenate the loaded number-name-dicts for several phonebook ids, keyed by the canonical numbers.
+        Entries with a trailing * go into a trie of prefixes instead, together with the given prefixes. """
+        number_name_dict = dict()
+        prefix_trie = DigitTrie()
+        prefixes = dict(prefixes) if isinstance(prefixes, dict) else {prefix: prefix for prefix in prefixes}
+        for pb_id in pb_ids:
+            number_name_dict.update(self.cp.normalizer.normalize_dict(self.pb_numbers[pb_id]))
+        for number in [number for number in number_name_dict if number.endswith('*')]:
+            prefixes[number] = number_name_dict.pop(number)
+        for prefix, name in prefixes.items():
+            canonical = self.cp.normalizer(prefix).rstrip('*')
+            if canonical.isdigit():
+                prefix_trie.add(canonical, name)
+            else:
+                log.warning(f'Ignoring prefix {prefix}, it would match everything or nothing')
+        return number_name_dict, prefix_trie
 
+    @traced('callblocker.examine')
     def parse_and_examine_line(self, raw_line):
         """ Parse call monitor line, if RING event not in lists, rate and maybe block the number. """
-        if time() - self.list_age >= 3600:  # Reload phonebooks if list is outdated
+        if time() - self.list_age >= self.refresh_sec:  # Refresh phonebooks if list is outdated
             self.reload_phonebooks()
         log.debug(raw_line)
         cm_line = CallMonitorLine(raw_line)
@@ -159,76 +387,147 @@ class CallBlocker:
 
             else:  # Caller WITH phone number
 
-                is_abroad = number.startswith('00') and not number.startswith(self.cp.country_code)
-
+                start = perf_counter()
                 if number.startswith('0'):
                     full_number = number  # Number with either country code or area code
                 else:
                     full_number = self.cp.area_code + number  # Number in same area network
 
-                # 1. Is either full number 071..123... or short number 123... in the white- or blacklist?
-                name_white = self.pb.get_name_for_number_in_dict(number, self.whitelist, area_code=self.cp.area_code)
-                name_black = self.pb.get_name_for_number_in_dict(number, self.blacklist, area_code=self.cp.area_code)
+                call = CallBlockerCall(self, cm_line, number, full_number)
+                if self.two_phase:
+                    # 1st phase: decide by local rules only, 2nd phase: online rules in the background if undecided.
+                    # The line is emitted before the enricher gets the call, which changes it then.
+                    rate = self.examine(call, local=True)
+                    raw_line = call.get_line(self.get_final_rate(call, rate))
+                    DECISION_SECONDS.observe(perf_counter() - start, 'local')
+                    self.emit_line(raw_line)
+                    if rate is None or self.get_final_rate(call, rate) == CallBlockerRate.BLOCK.value:
+                        self.enricher.submit(tracer.wrap(self.enrich, 'callblocker.enrich'), call, rate)
+                    return
+                rate = self.examine(call)
+                if self.get_final_rate(call, rate) == CallBlockerRate.BLOCK.value:
+                    self.block_number(call.get_name(), full_number)
+                raw_line = call.get_line(self.get_final_rate(call, rate))
+                DECISION_SECONDS.observe(perf_counter() - start, 'sync')
+
+            self.emit_line(raw_line)
 
-                if name_white and name_black:
-                    raise Exception(f'Problem in your phonebooks detected: '
-                                    f'a number should not be on white- and blacklist. Please fix! Details: '
-                                    f'whitelist:{name_white} blacklist:{name_black}')
+    @staticmethod
+    def get_default_rules():
+        """ Cheap local rules first, so the expensive online score is only asked if nothing else decided. """
+        return [ListsRule(), PrefixListsRule(), IllegalPrefixRule(), AbroadRule(), CachedScoreRule(), OnlineScoreRule()]
+
+    def examine(self, call, local=None):
+        """ Run the rules in order until one decides. Run only local or only online rules by local=True/False. """
+        for rule in self.rules:
+            if local is None or rule.local == local:
+                rate = rule(call)
+                if rate:
+                    return rate
+        return None
 
-                if name_white or name_black:
-                    name = name_black if name_black else name_white  # Reason: black might win over white by blocking it
-                    rate = CallBlockerRate.BLACKLIST.value if name_black else CallBlockerRate.WHITELIST.value
-                    raw_line = f'{dt};{rate};0;{full_number};"{name}";' + "\n"
+    @staticmethod
+    def get_final_rate(call, rate):
+        """ Undecided calls pass. Precaution: block only calls from outside, not from inside. """
+        if rate is None or (rate == CallBlockerRate.BLOCK.value and call.cm_line.type != CallMonitorType.RING.value):
+            return CallBlockerRate.PASS.value
+        return rate
+
+    def get_rule_stats(self):
+        """ Invocations, decisions and time spent per rule, to see where the decision latency goes. """
+        return [rule.get_stats() for rule in self.rules]
+
+    def is_bad_score(self, ci):
+        return ci.score >= self.min_score and ci.comments >= self.min_comments
+
+    def get_prefix_name(self, number, full_number):
+        """ Is the prefix (Vorwahl) valid, existing country code OR area code? Else return FAKE_PREFIX. """
+        # ToDo: check also if e.g. the prefix is inactive, e.g. DE_LANDLINE_INACTIVE
+        prefix_name = self.cp.get_prefix_name(full_number)
+        if not prefix_name and not number.startswith('00'):  # Do not block e.g. Inmarsat or similar
+            prefix_name = FAKE_PREFIX
+        return prefix_name
+
+    def enrich(self, call, rate):
+        """ Second phase, runs in the background: block if the first phase decided so, else rate by the online
+        rules, maybe block, log a follow-up line marked as enriched.
+        Runs serialized by one thread, so the same number is not added twice to the phonebook. """
+        start = perf_counter()
+        try:
+            with self.lists_lock:
+                if call.canonical in self.blacklist:
+                    return  # E.g. blocked meanwhile by a previous ring
+            if rate is None:
+                if all(rule.local for rule in self.rules):
+                    return
+                rate = self.examine(call, local=False)
+                call.method = CallInfoType.ENRICHED.value if call.ci else call.method
+                raw_line = call.get_line(self.get_final_rate(call, rate))
+            else:
+                raw_line = None  # Already logged by the first phase
+            if self.get_final_rate(call, rate) == CallBlockerRate.BLOCK.value:
+                self.block_number(call.get_name(), call.full_number)
+            DECISION_SECONDS.observe(perf_counter() - start, 'enriched')
+            if raw_line:
+                self.emit_line(raw_line, follow_up=True)
+        except Exception as e:
+            log.exception(f'Enrichment of {call.full_number} failed: {e}')
+
+    @traced('callblocker.block_number')
+    def block_number(self, name, full_number):
+        """ Add number to the blocklist phonebook, which should be configured to decline calls. The number is put
+        into the lists in memory first, so the next ring is blacklisted at once, no reload needed. The lock is held
+        for the lists in memory only, not during the call to the Fritz!Box, so examine does not stall behind it. """
+        name = self.blockname_prefix + name
+        self.set_blocked_in_lists(full_number, name, blocked=True)
+        result = None
+        try:
+            # The blocklist is part of the blacklist, so the ListsRule checked already that the number is not in there
+            result = self.pb.add_contact(self.blocklist_pbid, name, full_number, skip_existing=False)
+        finally:
+            # Set again if added, a reload meanwhile might have replaced the lists by a download without the number
+            self.set_blocked_in_lists(full_number, name, blocked=result == {})
+        if result:  # If not {} returned, it's an error
+            log.warning("Adding to phonebook failed:")
+            print(result)
+
+    def set_blocked_in_lists(self, full_number, name, blocked):
+        """ Add a blocked number to the blacklist and the loaded blocklist phonebook, or remove it if adding to the
+        phonebook failed, so it is tried again on the next ring. """
+        canonical = self.cp.normalizer(full_number)
+        with self.lists_lock:
+            if blocked:
+                self.blacklist[canonical] = name
+                self.pb_numbers[self.blocklist_pbid][full_number] = name
+            else:
+                self.blacklist.pop(canonical, None)
+                self.pb_numbers[self.blocklist_pbid].pop(full_number, None)
 
-                else:
-                    ci = CallInfo(full_number)
-                    ci.get_cascade_score()
-
-                    # ToDo: check also if e.g. the prefix is inactive, e.g. DE_LANDLINE_INACTIVE
-                    # Is the prefix (Vorwahl) valid, existing country code OR area code?
-                    prefix_name = self.cp.get_prefix_name(full_number)
-                    if not prefix_name and not number.startswith('00'):  # Do not block e.g. Inmarsat or similar
-                        prefix_name = FAKE_PREFIX
-
-                    # If there is no other information name at least the country or area
-                    if ci.name == UNKNOWN_NAME:
-                        ci.name = prefix_name
-
-                    # Adapt to logging style of call monitor. Task of logger to parse the values to keys/names?
-                    score_str = f'"{ci.name}";{ci.score};{ci.comments};{ci.searches};'
-
-                    # Bad code style here - should be rewritten soon
-                    if (self.block_illegal_prefix and prefix_name == FAKE_PREFIX) \
-                            or (self.block_abroad and is_abroad) \
-                            or (ci.score >= self.min_score and ci.comments >= self.min_comments):
-                        name = self.blockname_prefix + ci.name
-                        # Precaution: should only happen if this is a call from outside, not from inside
-                        if cm_line.type == CallMonitorType.RING.value:
-                            # ToDo: should go in extra method
-                            result = self.pb.add_contact(self.blocklist_pbid, name, full_number)
-                            if result:  # If not {} returned, it's an error
-                                log.warning("Adding to phonebook failed:")
-                                print(result)
-                            else:
-                                # Reload phonebook to prevent re-adding number for next ring event
-                                # self.blacklist = self.pb.get_all_numbers_for_pb_ids(self.blacklist_pbids)
-                                self.reload_phonebooks()
-                            rate = CallBlockerRate.BLOCK.value
-                        else:
-                            rate = CallBlockerRate.PASS.value
-                    else:
-                        rate = CallBlockerRate.PASS.value
-                    raw_line = f'{dt};{rate};1;{full_number};{score_str}' + "\n"
-
-            log.debug(raw_line)
-            parsed_line = CallBlockerLine(raw_line)
-            print(parsed_line)
-            if self.logger:
-                self.logger(raw_line)
-
-            # ToDo: add that an event is only posted once if same full_number and e.g. not same minute
-            if TELEGRAM_BOT_URL:
-                requests.get(TELEGRAM_BOT_URL + quote("CallBlocker: " + raw_line))
+    def emit_line(self, raw_line, follow_up=False):
+        """ Print, log and post a call blocker line. A follow-up is the enriched line of the two phase mode. """
+        log.debug(raw_line)
+        parsed_line = CallBlockerLine(raw_line)
+        print(parsed_line)
+        VERDICTS.inc(parsed_line.rate)
+        if self.logger:
+            self.logger(raw_line)
+
+        # An event is only posted once for the same number within the dedup time of the notifier, whatever rule hit.
+        # A follow-up has its own key with the rate, so the enriched verdict is posted after the instant one.
+        if self.notifier:
+            key = parsed_line.caller if parsed_line.caller else None
+            if key and follow_up:
+                key = f'{key};{CallInfoType.ENRICHED.value};{parsed_line.rate}'
+            self.notifier.notify(raw_line, key=key)
+
+    def stop(self):
+        """ Finish the pending enrichments, then stop the enricher thread and close the notifier. A buffered
+        CallBlockerLog given as logger is flushed and closed after the last enriched line. """
+        if self.enricher:
+            self.enricher.shutdown(wait=True)
+        if self.notifier:
+            self.notifier.close()
+        close_logger(self.logger)
 
 
 if __name__ == "__main__":
@@ -243,21 +542,21 @@ if __name__ == "__main__":
 
     # Idea: could also define which rating method should be used?
 
-    cb_log = CallBlockerLog(daily=True, anonymize=False)
+    cb_log = CallBlockerLog(daily=True, anonymize=False, buffered=True, archive=True)
     cb = CallBlocker(fc=fritzconn,
                      whitelist_pbids=[0], blacklist_pbids=[1, 2], blocklist_pbid=2, blockname_prefix='[Spam] ',
                      min_score=6, min_comments=2,
                      block_illegal_prefix=True, block_abroad=False,
-                     logger=cb_log.log_line)
+                     logger=cb_log.log_line, caches=get_default_caches(db_path=cb_log.log_folder + '/callinfo.sqlite'))
 
-    cm_log = CallMonitorLog(daily=True, anonymize=False)
+    cm_log = CallMonitorLog(daily=True, anonymize=False, buffered=True, archive=True)
     cm = CallMonitor(host=fritzconn.address, logger=cm_log.log_line, parser=cb.parse_and_examine_line)
 
     # Provoke whitelist test
     # test_line = '17.06.20 10:28:29;RING;0;07191952xxx;69xxx;SIP0;'; cb.parse_and_examine_line(test_line)
     # Provoke blacklist test
     # test_line = '17.06.20 10:28:29;RING;0;09912568741xxx;69xxx;SIP0;'; cb.parse_and_examine_line(test_line)
-    # cm.stop()
+    # cm.stop(); cb.stop()
 
     # Provoke CLIR (caller number suppressed)
     # test_line = '11.07.20 14:10:13;RING;0;;69xxx;SIP0;'; cb.parse_and_examine_line(test_line)
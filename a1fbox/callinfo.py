@@ -2,10 +2,20 @@
 
 import json5
 import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from enum import Enum
 
 import requests
 
+sys.path.append(os.path.dirname(__file__))
+from metrics import registry
+from ratelimit import RateLimiter, PROVIDER_TELLOWS, PROVIDER_DASOERTLICHE, PROVIDER_WEMGEHOERT
+from tracing import tracer, traced
+from utils import Caches
+
 logging.basicConfig(level=logging.WARNING)
 log = logging.getLogger(__name__)
 
@@ -15,6 +25,41 @@ UNRESOLVED_PREFIX_NAME = 'UNRESOLVED'  # Dependency: callprefix & ONB/RNB!
 
 session = requests.session()  # Re-use for wemgehoert.de
 
+REQUEST_TIMEOUT_SEC = 5  # Never wait forever for a provider
+NEUTRAL_SCORE = 5  # Tellows' score for a number without ratings, used until a score is known
+
+executor = ThreadPoolExecutor(max_workers=8)  # Shared by all concurrent cascades
+
+rate_limiter = None  # Shared by all CallInfos, and by default with other processes, too, see get_rate_limiter
+rate_limiter_lock = threading.Lock()
+
+REQUEST_SECONDS = registry.histogram('a1fbox_callinfo_request_seconds', 'HTTP latency, by provider', ['provider'])
+ERRORS = registry.counter('a1fbox_callinfo_errors_total', 'Failed requests, by provider', ['provider'])
+THROTTLED = registry.counter('a1fbox_callinfo_throttled_total', 'Requests skipped by rate limit, by provider',
+                             ['provider'])
+
+CACHE_TELLOWS = 'tellows'
+CACHE_REVSEARCH = 'revsearch'
+CACHE_TTL_SEC = {CACHE_TELLOWS: 24 * 3600, CACHE_REVSEARCH: 7 * 24 * 3600}
+CACHE_NEGATIVE_TTL_SEC = {CACHE_TELLOWS: 3600, CACHE_REVSEARCH: 24 * 3600}
+
+
+def get_default_caches(db_path=None, max_entries=10000, normalizer=None):
+    """ Create caches for CallInfo lookups with default ttls, optionally persisted to a SQLite file.
+    Keyed by canonical numbers if a normalizer is given, e.g. CallPrefix.normalizer. """
+    return Caches([CACHE_TELLOWS, CACHE_REVSEARCH], ttl_sec=CACHE_TTL_SEC, negative_ttl_sec=CACHE_NEGATIVE_TTL_SEC,
+                  max_entries=max_entries, db_path=db_path, normalizer=normalizer)
+
+
+def get_rate_limiter():
+    """ Create the shared rate limiter on first use, so importing this module does not create its state folder. """
+    global rate_limiter
+    if rate_limiter is None:
+        with rate_limiter_lock:
+            if rate_limiter is None:
+                rate_limiter = RateLimiter()
+    return rate_limiter
+
 
 class CallInfoType(Enum):
     """ Which method has been used to enrich the data, if none it's 0. """
@@ -24,22 +69,36 @@ class CallInfoType(Enum):
     WEMGEHOERT_SCORE = 2
     REV_SEARCH = 100
     CASCADE = 101
+    ENRICHED = 102  # Follow-up of the call blocker's two phase mode, with cascade score
 
 
 class CallInfo:
     """ Retrieve details for a phone number. Currently scoring via Tellows or naming a number via reverse search. """
 
-    def __init__(self, number, name=None, location=None):
-        """ Might enrich information about a phone number. Caches not used yet. """
+    def __init__(self, number, name=None, location=None, caches=None, max_wait_sec=None):
+        """ Might enrich information about a phone number. If caches are given (see get_default_caches),
+        the results of tellows and reverse search are cached. Each request waits for the rate limiter of its
+        provider, at most max_wait_sec (default: the request timeout), otherwise the request is skipped. """
         self.number = number
+        self.caches = caches
         self.name = name if name else UNKNOWN_NAME
         self.location = location if location else UNKNOWN_LOCATION
         self.prefix_name = UNRESOLVED_PREFIX_NAME
         self.method = CallInfoType.INIT.value
-
-    def get_cascade_score(self):
+        self.score, self.comments, self.searches = NEUTRAL_SCORE, 0, 0
+        self.timeout = REQUEST_TIMEOUT_SEC
+        self.max_wait_sec = max_wait_sec
+        self.timed_out = []  # Providers which did not answer within the deadline of a concurrent cascade
+        self.cache_lookups = dict()  # Source: result of the cache lookup, None if missed, see get_cached
+
+    @traced('callinfo.cascade')
+    def get_cascade_score(self, deadline_sec=None):
         """ Combine tellows, wemgehoert and rev search. If tellows score is <= 5, try also wemgehoert.de.
-        If name of rev search is longer than the one returned from tellows, first will be used. """
+        If name of rev search is longer than the one returned from tellows, first will be used.
+        If a deadline is given, the providers are queried concurrently, results not there in time are ignored. """
+        if deadline_sec:
+            self.get_concurrent_cascade_score(deadline_sec)
+            return
         self.get_revsearch_info()
         rev_name = self.name
         self.get_tellows_score()
@@ -51,6 +110,50 @@ class CallInfo:
         #     self.get_wemgehoert_score()
         self.method = CallInfoType.CASCADE.value
 
+    def get_concurrent_cascade_score(self, deadline_sec):
+        """ Like the cascade, but rev search and tellows run at the same time, bounded by deadline_sec overall.
+        Each provider works on an own CallInfo, the results in time are merged by the same rules. """
+        rev = CallInfo(self.number, name=self.name, location=self.location, caches=self.caches)
+        tel = CallInfo(self.number, name=self.name, location=self.location, caches=self.caches)
+        rev.timeout = tel.timeout = deadline_sec
+        rev.max_wait_sec = tel.max_wait_sec = self.max_wait_sec
+        rev.cache_lookups = tel.cache_lookups = self.cache_lookups
+        # Wrapped to trace them in the executor's threads as well, the time waiting for a thread is kept as queued_ms
+        rev_info, tel_score = tracer.wrap(rev.get_revsearch_info, 'callinfo.submitted'), \
+            tracer.wrap(tel.get_tellows_score, 'callinfo.submitted')
+        futures = {executor.submit(rev_info): CallInfoType.REV_SEARCH,
+                   executor.submit(tel_score): CallInfoType.TELLOWS_SCORE}
+        done, not_done = wait(futures, timeout=deadline_sec)
+        self.timed_out = [futures[future].name for future in not_done]
+        if self.timed_out:
+            log.warning(f'{self.number}: no answer within {deadline_sec}s from {", ".join(self.timed_out)}')
+        rev_done = any(futures[future] == CallInfoType.REV_SEARCH for future in done)
+        tel_done = any(futures[future] == CallInfoType.TELLOWS_SCORE for future in done)
+        rev_name = rev.name if rev_done else self.name
+        tel_name = rev_name
+        if tel_done:
+            self.score, self.comments, self.searches = tel.score, tel.comments, tel.searches
+            self.location = tel.location
+            if tel.name != self.name:  # Tellows found a name
+                tel_name = tel.name
+        self.name = rev_name if len(rev_name) > len(tel_name) else tel_name
+        self.method = CallInfoType.CASCADE.value
+
+    def acquire(self, provider):
+        """ Wait for the rate limiter of provider. False if throttled longer than allowed, skip the request then. """
+        if get_rate_limiter().acquire(provider, self.max_wait_sec if self.max_wait_sec is not None else self.timeout):
+            return True
+        log.warning(f'{self.number}: request to {provider} skipped, rate limit reached')
+        THROTTLED.inc(provider)
+        return False
+
+    def get_cached(self, source):
+        """ Look up the caches once per source, e.g. the call blocker's CachedScoreRule and a following online score
+        share the result, so a lookup is counted once in the hit/miss stats. """
+        if source not in self.cache_lookups:
+            self.cache_lookups[source] = self.caches.get_source_key_obj(source, self.number)
+        return self.cache_lookups[source]
+
     def get_location(self, unknown_only=True):
         """ PLANNED. Retrieve location by using ONB list. Optionally only if not retrieved otherwise before. """
         if unknown_only and self.location != UNKNOWN_LOCATION:
@@ -58,22 +161,29 @@ class CallInfo:
         # Planning to implement, but for that we need to combine callprefix & callinfo somehow..
         pass
 
+    @traced('callinfo.tellows')
     def get_tellows_score(self):
         """ Do scoring for a phone number via Tellows - extract score, comments, build a name:
         https://blog.tellows.de/2011/07/tellows-api-fur-die-integration-in-eigene-programme/ -
         use only if country is in list of https://www.tellows.de/api/getsupportedcountries ?
         Unfortunately the company name is missing in JSON/XML output, but present in HTML? """
         self.method = CallInfoType.TELLOWS_SCORE.value
+        if self.caches:
+            info = self.get_cached(CACHE_TELLOWS)
+            if info is not None:
+                self.set_tellows_info(info)
+                return
+        if not self.acquire(PROVIDER_TELLOWS):
+            return
         url = f'http://www.tellows.de/basic/num/{self.number}?json=1&partner=test&apikey=test123'
         try:
-            req = requests.get(url)
+            with REQUEST_SECONDS.time(PROVIDER_TELLOWS):
+                req = requests.get(url, timeout=self.timeout)
             req.raise_for_status()
 
             obj = req.json()['tellows']
-            self.score = int(obj['score'])
-            self.comments = int(obj['comments'])
-            self.searches = obj['searches']
-            self.location = obj['location']
+            info = {'score': int(obj['score']), 'comments': int(obj['comments']),
+                    'searches': obj['searches'], 'location': obj['location']}
 
             caller_name = ''
             if 'numberDetails' in obj and 'name' in obj['numberDetails']:
@@ -91,15 +201,32 @@ class CallInfo:
                                 continue
                             caller_name = name_count['name']
                             break  # Stop for first meaningful name
-            # Do not set just the location, this is the task of ONB/RNB etc. "T-Mobile" is reported as location..
-            if caller_name:
-                self.name = f'{caller_name}, {self.location}'
-        except requests.exceptions.HTTPError as err:
+            info['caller_name'] = caller_name
+            self.set_tellows_info(info)
+            if self.caches:
+                # No comments and no name means tellows knows nothing about this number
+                negative = not caller_name and info['comments'] == 0
+                self.caches.add_source_key_obj(CACHE_TELLOWS, self.number, info, negative=negative)
+        except requests.exceptions.RequestException as err:
+            ERRORS.inc(PROVIDER_TELLOWS)
             log.warning(err)
 
+    def set_tellows_info(self, info):
+        """ Set score, comments, searches, location and name from a (cached) tellows result. """
+        self.score = info['score']
+        self.comments = info['comments']
+        self.searches = info['searches']
+        self.location = info['location']
+        # Do not set just the location, this is the task of ONB/RNB etc. "T-Mobile" is reported as location..
+        if info['caller_name']:
+            self.name = f'{info["caller_name"]}, {self.location}'
+
+    @traced('callinfo.wemgehoert')
     def get_wemgehoert_score(self):
         """ Do scoring for a phone number via wemgehoert.de - extract percentage as score. CURRENTLY DOES NOT WORK! """
         self.method = CallInfoType.WEMGEHOERT_SCORE.value
+        if not self.acquire(PROVIDER_WEMGEHOERT):
+            return
         url = f'https://www.wemgehoert.de/nummer/{self.number}'
 
         headers = {
@@ -110,7 +237,8 @@ class CallInfo:
         }
 
         try:
-            req = session.get(url, headers=headers)
+            with REQUEST_SECONDS.time(PROVIDER_WEMGEHOERT):
+                req = session.get(url, headers=headers, timeout=self.timeout)
             req.raise_for_status()
             content = req.text
             # Extract 84 from e.g. <div id="progress-bar-inner" class="progress-bar-rank5">84</div>
@@ -123,7 +251,8 @@ class CallInfo:
                 if pos_n != -1:
                     content = content[:pos_n]
                     self.score = round(int(content) / 10)  # e.g. 84% becomes score = 8
-        except requests.exceptions.HTTPError as err:
+        except requests.exceptions.RequestException as err:
+            ERRORS.inc(PROVIDER_WEMGEHOERT)
             log.warning(err)
 
     def get_numreport_name(self):
@@ -133,16 +262,27 @@ class CallInfo:
         and many other checks are done (origin/referer?), returns otherwise http 400. """
         pass
 
+    @traced('callinfo.revsearch')
     def get_revsearch_info(self):
         """ Do reverse search via DasOertliche, currently ugly parsing, which might fail if name has commas? """
         self.method = CallInfoType.REV_SEARCH.value
+        if self.caches:
+            info = self.get_cached(CACHE_REVSEARCH)
+            if info is not None:
+                if info:
+                    self.name = info['name']
+                return
+        rev_name = None
         code_2020 = False
         if code_2020:
             url = f'https://www.dasoertliche.de/Controller?form_name=search_inv&ph={self.number}'
         else:
             url = f'https://www.dasoertliche.de/rueckwaertssuche/?ph={self.number}&pa=&address='
+        if not self.acquire(PROVIDER_DASOERTLICHE):
+            return
         try:
-            req = requests.get(url)
+            with REQUEST_SECONDS.time(PROVIDER_DASOERTLICHE):
+                req = requests.get(url, timeout=self.timeout)
             req.raise_for_status()
             content = req.text
 
@@ -159,7 +299,7 @@ class CallInfo:
                         parts = content.split(',')
                         city = parts[5].strip("' ")  # "ci" in source view
                         name = parts[14].strip("' ")  # "na" in source view
-                        self.name = name + ", " + city
+                        rev_name = name + ", " + city
                         # self.location = city
 
             else:
@@ -177,10 +317,17 @@ class CallInfo:
                         city = res['city']
                         name = res['name']
                         # More data would be available: street, zip, phones, email
-                        self.name = name + ", " + city
+                        rev_name = name + ", " + city
                         # self.location = city
 
-        except requests.exceptions.HTTPError as err:
+            if rev_name:
+                self.name = rev_name
+            if self.caches:
+                info = {'name': rev_name} if rev_name else {}
+                self.caches.add_source_key_obj(CACHE_REVSEARCH, self.number, info, negative=not rev_name)
+
+        except requests.exceptions.RequestException as err:
+            ERRORS.inc(PROVIDER_DASOERTLICHE)
             log.warning(err)
 
     def __str__(self, add_link=True):
@@ -223,3 +370,8 @@ if __name__ == "__main__":
     ci.get_cascade_score()
     assert ci.method == CallInfoType.CASCADE.value
     print(ci)
+
+    ci = CallInfo(number)
+    ci.get_cascade_score(deadline_sec=0.8)
+    assert ci.method == CallInfoType.CASCADE.value
+    print(ci, ci.timed_out)
@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 
 from collections import Counter
-from time import sleep
 from xml.etree import ElementTree as ET
 
 from fritzconnection.lib.fritzcall import FritzCall
@@ -11,6 +10,7 @@ from callinfo import CallInfo
 from callprefix import CallPrefix
 from fritzconn import FritzConn
 from phonebook import Phonebook
+from utils import DigitTrie
 
 if __name__ == "__main__":
     # Quick example how to use only
@@ -25,7 +25,11 @@ if __name__ == "__main__":
     fi = FritzInspection(fc=fritzconn)
     # print(fi.view_servicenames())
 
-    anylist = pb.get_all_numbers_for_pb_ids([0, 1, 2], keep_internals=False)  # White- or blacklist
+    # White- or blacklist, keyed by canonical numbers like 00497191808123
+    anylist = cp.normalizer.normalize_dict(pb.get_all_numbers_for_pb_ids([0, 1, 2], keep_internals=False))
+    # Entries with a trailing *, like 0039* for Italy, are prefixes
+    prefixes = DigitTrie({number: name for number, name in anylist.items()
+                          if number.endswith('*') and number.rstrip('*').isdigit()})
 
     print("VoIP numbers (XML):")
     res = pb.get_voip_numbers()
@@ -35,8 +39,7 @@ if __name__ == "__main__":
     tree = ET.fromstring(res)
     iphones = dict()
     for node in tree.iter('Number'):
-        nr = cp.area_code + node.text
-        iphones.update({nr: 'intern'})
+        iphones.update({cp.normalizer(node.text): 'intern'})
     anylist.update(iphones)
     print(iphones)
 
@@ -72,7 +75,7 @@ if __name__ == "__main__":
     print('\nWhite- or blacklisted:')
     unknowns = set()
     for number in numbers:
-        name = pb.get_name_for_number_in_dict(number, anylist, area_code=cp.area_code)
+        name = anylist.get(cp.normalizer(number))
         if name:
             print(f'{number} {name}')
         else:
@@ -83,16 +86,16 @@ if __name__ == "__main__":
 
     # Idea: rate & info ... auto-block .. or add good names to whitelist?
     print(f'\nResolving Unknowns: {len(unknowns)}')
-    for unknown in unknowns:
+    _, prefix_names, _ = cp.get_prefix_arrays(unknowns)  # All at once, vectorized if NumPy is installed
+    for unknown, prefix_name in zip(unknowns, prefix_names):
         # Skip those starting with a prefix in phonebooks, e.g. 0039(*) for Italy, 069660(*), 0211945(*)
-        if any(known in unknown for known in anylist):
+        if prefixes.get_longest_match(cp.normalizer(unknown)):
             print("skipped as prefix found in phonebook: " + unknown)
             continue
-        ci = CallInfo(unknown)
+        ci = CallInfo(unknown, max_wait_sec=300)  # Rate limited, anti-DDOS needed for tellows (and wemgehoert)
         ci.get_cascade_score()
         if not ci.location:
-            ci.location = cp.get_prefix_name(unknown)
+            ci.location = prefix_name
         print(ci)
-        sleep(4)  # Anti-DDOS needed for tellows (and if used, wemgehoert), otherwise you get blocked or captcha
 
     print('\nREADY.')
@@ -1,9 +1,14 @@
 #!/usr/bin/python3
 
+import asyncio
 import contextlib
+import contextvars
+import functools
+import inspect
 import logging
 import os
 import platform
+import queue
 import socket
 import sys
 import threading
@@ -12,11 +17,40 @@ from enum import Enum
 
 sys.path.append(os.path.dirname(__file__))
 from fritzconn import FritzConn
-from utils import Log, anonymize_number
+from metrics import registry
+from tracing import tracer
+from utils import Log, anonymize_number, datetime_to_epoch, get_line_epoch
 
 logging.basicConfig(level=logging.WARNING)
 log = logging.getLogger(__name__)
 
+LINES = registry.counter('a1fbox_callmonitor_lines_total', 'Call monitor lines received, by type', ['type'])
+RECONNECTS = registry.counter('a1fbox_callmonitor_reconnects_total', 'Call monitor reconnects, by host', ['host'])
+
+
+def create_tcp_keep_alive_socket():
+    """ Create an unconnected tcp socket with keep-alive enabled, used by the sync and the async call monitor. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # See: https://stackoverflow.com/questions/12248132/how-to-change-tcp-keepalive-timer-using-python-script
+    keep_alive_sec = 10
+    after_idle_sec = 1
+    interval_sec = 3
+    max_fails = 5
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    op_sys = platform.system()
+    if op_sys == 'Windows':
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, keep_alive_sec * 1000, interval_sec * 1000))
+    elif op_sys == 'Darwin':  # Mac
+        TCP_KEEPALIVE = 0x10
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_KEEPALIVE, interval_sec)
+    elif op_sys == 'Linux':
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, after_idle_sec)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval_sec)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max_fails)
+    else:
+        print("You use an unidentified operating system: {}".format(op_sys))
+    return sock
+
 
 class CallMonitorType(Enum):
     """ Relevant call types in received lines from call monitor. """
@@ -74,84 +108,358 @@ class CallMonitorLine:
         return switcher.get(self.type, 'NOT IMPLEMENTED CALL TYPE {}'.format(self.type))
 
 
+# Interned type strings, so the type of a record can be compared cheaply, even with 'is'
+RECORD_TYPES = {member.value.encode(): member.value for member in CallMonitorType}
+
+# Index of the parameters in a line split by ';', which depends on the type
+RECORD_FIELDS = {
+    CallMonitorType.RING.value: {'caller': 3, 'callee': 4, 'device': 5},
+    CallMonitorType.CALL.value: {'ext_id': 3, 'caller': 4, 'callee': 5, 'device': 6},
+    CallMonitorType.CONNECT.value: {'ext_id': 3, 'caller': 4},
+    CallMonitorType.DISCONNECT.value: {'duration': 3},
+}
+
+
+class CallMonitorRecord:
+    """ Compact alternative to CallMonitorLine: keeps the raw parameters as bytes and decodes on access only.
+    Provides the same attributes like CallMonitorLine, plus the timestamp as epoch. """
+
+    __slots__ = ('params', 'type', 'epoch')
+
+    def __init__(self, raw_line):
+        """ Parse a raw line, preferably bytes as received from the socket. """
+        if isinstance(raw_line, str):
+            raw_line = raw_line.encode('utf-8')
+        self.params = raw_line.strip().split(b';', 7)
+        self.type = RECORD_TYPES.get(self.params[1]) or self.params[1].decode('utf-8')
+        self.epoch = datetime_to_epoch(self.params[0])
+
+    def get_field(self, name, default=None):
+        index = RECORD_FIELDS.get(self.type, {}).get(name)
+        return self.params[index].decode('utf-8') if index is not None else default
+
+    @property
+    def datetime(self):
+        return self.params[0].decode('utf-8')
+
+    @property
+    def date(self):
+        return self.params[0][:8].decode('utf-8')
+
+    @property
+    def time(self):
+        return self.params[0][9:].decode('utf-8')
+
+    @property
+    def conn_id(self):
+        return self.params[2].decode('utf-8')
+
+    @property
+    def ext_id(self):
+        return self.get_field('ext_id')
+
+    @property
+    def caller(self):
+        return self.get_field('caller')
+
+    @property
+    def callee(self):
+        return self.get_field('callee')
+
+    @property
+    def device(self):
+        return self.get_field('device')
+
+    @property
+    def duration(self):
+        return self.get_field('duration', 0)
+
+    @property
+    def raw_line(self):
+        """ The line as received, e.g. to be passed to a logger. """
+        return b';'.join(self.params).decode('utf-8') + "\n"
+
+    __str__ = CallMonitorLine.__str__
+
+
+class CallMonitorReader:
+    """ Read call monitor lines from a socket or a binary file into one reusable buffer, yield CallMonitorRecords.
+    Lines which are empty or start with '#' are skipped, malformed ones are logged and skipped. """
+
+    def __init__(self, source, buffer_size=65536):
+        """ Source is a socket (uses recv_into) or a file opened with 'rb' (uses readinto). """
+        self.read_into = getattr(source, 'recv_into', None) or source.readinto
+        self.buffer = bytearray(buffer_size)
+
+    def __iter__(self):
+        buf = self.buffer
+        end = 0
+        while True:
+            last = buf.rfind(b'\n', 0, end)
+            if last != -1:  # Split all complete lines at once, keep the incomplete rest at the begin of the buffer
+                for line in bytes(buf[:last]).split(b'\n'):
+                    if line.strip() and not line.startswith(b'#'):
+                        try:
+                            record = CallMonitorRecord(line)
+                        except (ValueError, IndexError, OverflowError) as e:  # Must not stop the listener
+                            log.warning(f'Skipped malformed call monitor line {line!r}: {e}')
+                            continue
+                        yield record
+                buf[:end - last - 1] = buf[last + 1:end]
+                end -= last + 1
+            if end == len(buf):  # Line longer than the buffer
+                buf.extend(bytes(len(buf)))
+            with memoryview(buf) as view:
+                received = self.read_into(view[end:])
+            if not received:  # End of stream
+                break
+            end += received
+
+
 class CallMonitorLog(Log):
     """ Call monitor lines are logged to a file, optionally anonymized. Use log_line as logger for callmonitor. """
 
-    def __init__(self, file_prefix="callmonitor", log_folder=None, daily=False, anonymize=False):
-        super().__init__(file_prefix, log_folder, daily, anonymize)
+    def __init__(self, file_prefix="callmonitor", log_folder=None, daily=False, anonymize=False, **kwargs):
+        super().__init__(file_prefix, log_folder, daily, anonymize, **kwargs)
 
     def log_line(self, line):
         """ Append a raw call monitor line to the log file. Optionally anonymize phone numbers. """
-        filepath = self.get_log_filepath()
         if self.do_anon:
             line = CallMonitorLine.anonymize(line)
-        with open(filepath, "a", encoding='utf-8') as f:
-            f.write(line)
+        self.write_line(line)
+
+    def query(self, start, end):
+        """ Yield parsed CallMonitorLines logged within [start, end), e.g. from compressed daily archives. """
+        for raw_line in self.query_raw_lines(start, end):
+            yield CallMonitorLine(raw_line)
 
     def parse_from_file(self, raw_file_path, print_raw=False, anonymize=False):
         """ Read from raw file and parse each line. For unit tests OR EVEN INJECTION (instead of socket) later. """
-        with open(raw_file_path, "r", encoding='utf-8') as f:
-            for line in f.readlines():
-                # Remove comments
-                hash_pos = line.find('#')
-                if hash_pos != -1:
-                    line = line[:hash_pos]
-                # Remove newline, skip empty lines
-                line = line.strip()
-                if not line:
-                    continue
-                # Re-append previously stripped newline
-                line += "\n"
-                if anonymize:
-                    CallMonitorLine.anonymize(line)
-                if print_raw:
-                    print(line.strip())
-                else:
-                    cm_line = CallMonitorLine(line)
-                    print(cm_line)
+        for line in read_raw_lines(raw_file_path):
+            if anonymize:
+                line = CallMonitorLine.anonymize(line)
+            if print_raw:
+                print(line.strip())
+            else:
+                cm_line = CallMonitorLine(line)
+                print(cm_line)
+
+
+def get_line_type(raw_line):
+    """ Type of a raw line like RING, cheap enough for counting every line. """
+    parts = raw_line.split(';', 2)
+    return parts[1] if len(parts) > 2 else 'UNKNOWN'
+
+
+def flush_logger(logger):
+    """ Write the lines buffered by a logger like CallMonitorLog(buffered=True).log_line, if it is a method of a Log.
+    The Log stays open, it belongs to the caller, who might share it. """
+    log_obj = getattr(logger, '__self__', None)
+    if isinstance(log_obj, Log):
+        log_obj.flush()
+
+
+def close_logger(logger):
+    """ Flush and close a buffered logger like CallBlockerLog(buffered=True).log_line, if it is a method of a Log. """
+    log_obj = getattr(logger, '__self__', None)
+    if isinstance(log_obj, Log):
+        log_obj.close()
+
+
+def read_raw_lines(raw_file_path):
+    """ Stream the lines of a raw call monitor log, without reading the whole file. Comments and empty lines
+    are removed, each yielded line ends with a newline like received from the call monitor. """
+    with open(raw_file_path, "r", encoding='utf-8') as f:
+        for line in f:
+            # Remove comments
+            hash_pos = line.find('#')
+            if hash_pos != -1:
+                line = line[:hash_pos]
+            # Remove newline, skip empty lines
+            line = line.strip()
+            if not line:
+                continue
+            # Re-append previously stripped newline
+            yield line + "\n"
+
+
+class CallMonitorReplay:
+    """ Replay recorded call monitor logs through the same parser/logger callbacks like a live CallMonitor. """
+
+    def __init__(self, raw_file_paths, logger=None, parser=None, speed=None):
+        """ Provide one or several raw log files, replayed in the given order. If speed is None the lines are
+        replayed as fast as possible, else the original timestamps are honoured, but speed times faster. """
+        if isinstance(raw_file_paths, str):
+            raw_file_paths = [raw_file_paths]
+        self.raw_file_paths = raw_file_paths
+        self.parser = parser if parser else self.parse_line
+        self.logger = logger
+        self.speed = speed
+        self.do_run = True
+
+    @staticmethod
+    def from_folder(log_folder=None, file_prefix="callmonitor", **kwargs):
+        """ Replay all daily logs like callmonitor-YYYYMMDD.log of a log folder, ordered by date. """
+        log_folder = log_folder if log_folder else os.path.join(os.path.dirname(__file__), "../log")
+        names = sorted(name for name in os.listdir(log_folder)
+                       if name.startswith(file_prefix + '-') and name[len(file_prefix) + 1:-4].isdigit()
+                       and name.endswith('.log'))
+        return CallMonitorReplay([os.path.join(log_folder, name) for name in names], **kwargs)
+
+    def parse_line(self, raw_line):
+        """ Default parser method for replayed call monitor lines. """
+        log.debug(raw_line)
+        parsed_line = CallMonitorLine(raw_line)
+        print(parsed_line)
+
+    def run(self):
+        """ Replay all lines, blocking until done or stop() is called. Returns throughput statistics. """
+        files, lines = 0, 0
+        first_epoch, start = None, time.perf_counter()
+        for raw_file_path in self.raw_file_paths:
+            if not self.do_run:
+                break  # Do not even open the remaining files
+            files += 1
+            for raw_line in read_raw_lines(raw_file_path):
+                if not self.do_run:
+                    break
+                if self.speed:
+                    epoch = get_line_epoch(raw_line)
+                    if epoch is not None:
+                        if first_epoch is None:
+                            first_epoch = epoch
+                        delay = start + (epoch - first_epoch) / self.speed - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                self.parser(raw_line)
+                if self.logger:
+                    self.logger(raw_line)
+                lines += 1
+        seconds = time.perf_counter() - start
+        return {'files': files, 'lines': lines, 'seconds': round(seconds, 3),
+                'lines_per_sec': round(lines / seconds, 1) if seconds else 0}
+
+    def stop(self):
+        """ Stop a replay running in another thread. """
+        self.do_run = False
+
+
+class CallMonitorWorkerPool:
+    """ Decouple the socket reader from a slow parser: lines are queued and parsed by a pool of worker threads. """
+
+    def __init__(self, parser, workers=2, max_queue=1000, block_sec=0):
+        """ Each worker has an own bounded queue and a line is assigned by its conn_id, so the lines of the same
+        connection are parsed in order. If a queue is full, wait up to block_sec (backpressure), then drop the line.
+        With block_sec=0 the reader never stalls. If workers > 1 the parser has to be thread-safe. """
+        self.parser = parser
+        self.block_sec = block_sec
+        self.lock = threading.Lock()
+        self.submitted, self.processed, self.dropped, self.backpressure, self.errors = 0, 0, 0, 0, 0
+        self.queues = [queue.Queue(maxsize=max_queue) for _ in range(workers)]
+        self.threads = [threading.Thread(target=self.worker_thread, args=(q,), daemon=True) for q in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    @staticmethod
+    def get_conn_id(raw_line):
+        """ Extract the conn_id, which is always the third parameter, without parsing the whole line. """
+        params = raw_line.split(';', 3)
+        return params[2] if len(params) > 2 else ''
+
+    def get_queue(self, raw_line):
+        """ Map a line to the queue of a worker, same conn_id always goes to the same worker. """
+        conn_id = raw_line.conn_id if isinstance(raw_line, CallMonitorRecord) else self.get_conn_id(raw_line)
+        index = int(conn_id) if conn_id.isdigit() else hash(conn_id)
+        return self.queues[index % len(self.queues)]
+
+    def submit(self, raw_line):
+        """ Queue a raw line for parsing, use this as parser for the call monitor. Returns False if dropped. """
+        q = self.get_queue(raw_line)
+        self.submitted += 1
+        try:
+            q.put_nowait(raw_line)
+            return True
+        except queue.Full:
+            self.backpressure += 1
+        if self.block_sec:
+            try:
+                q.put(raw_line, timeout=self.block_sec)
+                return True
+            except queue.Full:
+                pass
+        self.dropped += 1
+        log.warning(f'Parser queue full, dropped line: {str(raw_line).strip()}')
+        return False
+
+    def worker_thread(self, q):
+        """ Parse the lines of one queue in order, until the stop marker None is received. """
+        while True:
+            raw_line = q.get()
+            if raw_line is None:
+                break
+            try:
+                self.parser(raw_line)
+            except Exception as e:
+                log.exception(f'Parser failed on line {str(raw_line).strip()}: {e}')
+                with self.lock:
+                    self.errors += 1
+            with self.lock:
+                self.processed += 1
+
+    def get_stats(self):
+        """ Return current queue depths and the counters, e.g. to be monitored. """
+        depths = [q.qsize() for q in self.queues]
+        return {'queue_depth': sum(depths), 'max_worker_depth': max(depths), 'workers': len(self.queues),
+                'submitted': self.submitted, 'processed': self.processed, 'dropped': self.dropped,
+                'backpressure': self.backpressure, 'errors': self.errors}
+
+    def stop(self):
+        """ Parse the already queued lines, then stop the workers. """
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
 
 
 class CallMonitor:
     """ Connect and listen to call monitor of Fritzbox, port is by default 1012. Enable it by dialing #96*5*. """
 
-    def __init__(self, host=None, port=1012, autostart=True, logger=None, parser=None):
-        """ By default will start the call monitor automatically and parse the lines. """
+    def __init__(self, host=None, port=1012, autostart=True, logger=None, parser=None,
+                 workers=0, max_queue=1000, block_sec=0, use_records=False):
+        """ By default will start the call monitor automatically and parse the lines. If workers > 0, the lines are
+        passed to the parser by a CallMonitorWorkerPool, so a slow parser does not block reading the socket.
+        If use_records is set, the parser receives a CallMonitorRecord instead of the raw line (str). """
         self.host = host.replace('https://', '').replace('http://', '')
         self.port = port
         self.socket = None
         self.thread = None
         self.parser = parser if parser else self.parse_line
         self.logger = logger
+        self.use_records = use_records
+        self.pool = None
+        if workers > 0:
+            self.pool = CallMonitorWorkerPool(self.parse_traced, workers=workers, max_queue=max_queue,
+                                              block_sec=block_sec)
         if autostart:
             self.start()
 
     def parse_line(self, raw_line):
         """ Default parser method for received call monitor lines. """
         log.debug(raw_line)
-        parsed_line = CallMonitorLine(raw_line)
+        parsed_line = raw_line if isinstance(raw_line, CallMonitorRecord) else CallMonitorLine(raw_line)
         print(parsed_line)
 
+    def parse_traced(self, raw_line):
+        """ Call the parser, within a new trace if the line is sampled. """
+        if not tracer.sample_rate:
+            return self.parser(raw_line)
+        line_type = raw_line.type if isinstance(raw_line, CallMonitorRecord) else get_line_type(raw_line)
+        with tracer.start_trace('callmonitor.line', type=line_type, host=self.host):
+            return self.parser(raw_line)
+
     def connect_tcp_keep_alive_socket(self):
         """ Socket has to use tcp keep-alive, otherwise call monitor from Fritzbox stops reporting after some time. """
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # See: https://stackoverflow.com/questions/12248132/how-to-change-tcp-keepalive-timer-using-python-script
-        keep_alive_sec = 10
-        after_idle_sec = 1
-        interval_sec = 3
-        max_fails = 5
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        op_sys = platform.system()
-        if op_sys == 'Windows':
-            self.socket.ioctl(socket.SIO_KEEPALIVE_VALS, (1, keep_alive_sec * 1000, interval_sec * 1000))
-        elif op_sys == 'Darwin':  # Mac
-            TCP_KEEPALIVE = 0x10
-            self.socket.setsockopt(socket.IPPROTO_TCP, TCP_KEEPALIVE, interval_sec)
-        elif op_sys == 'Linux':
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, after_idle_sec)
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval_sec)
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max_fails)
-        else:
-            print("You use an unidentified operating system: {}".format(op_sys))
+        self.socket = create_tcp_keep_alive_socket()
         self.socket.connect((self.host, self.port))
 
     def start(self):
@@ -168,13 +476,16 @@ class CallMonitor:
             log.error("Error: {}\nDid you enable the call monitor by 'dialing' #96*5*?".format(e))
 
     def stop(self):
-        """ Stop the socket connection and the listener thread. """
+        """ Stop the socket connection and the listener thread. A buffered logger is flushed, but stays open. """
         log.info("Stop listening..")
         self.thread.do_run = False  # More reliable than while (self.active)
         if self.socket:
             self.socket.shutdown(socket.SHUT_RDWR)
         if self.thread and self.thread.is_alive():
             self.thread.join()
+        if self.pool:
+            self.pool.stop()
+        flush_logger(self.logger)
 
     def listen_thread(self):
         """ Listen to the call monitor socket connection. Have to be TCP keep alive enabled. """
@@ -182,20 +493,32 @@ class CallMonitor:
         print("Call monitor listening started..")
         # https://stackoverflow.com/questions/18018033/how-to-stop-a-looping-thread-in-python
         t = threading.currentThread()
+        dispatch = self.pool.submit if self.pool else self.parse_traced
         while getattr(t, "do_run", True):
             try:
                 if not self.socket or self.socket._closed:
                     log.warning("Socket closed - reconnecting..")
+                    RECONNECTS.inc(self.host)
                     self.connect_tcp_keep_alive_socket()
                     # Socket is reconnected even if network cable is unplugged, continues to work after plugged in
                     if self.socket:
                         print("Socket reconnected..")
-                with contextlib.closing(self.socket.makefile()) as file:
-                    line_generator = (line for line in file if file)
-                    for raw_line in line_generator:
-                        self.parser(raw_line)
+                if self.use_records:
+                    for record in CallMonitorReader(self.socket):
+                        LINES.inc(record.type)
+                        dispatch(record)
                         if self.logger:
-                            self.logger(raw_line)
+                            self.logger(record.raw_line)
+                else:
+                    with contextlib.closing(self.socket.makefile()) as file:
+                        line_generator = (line for line in file if file)
+                        for raw_line in line_generator:
+                            LINES.inc(get_line_type(raw_line))
+                            dispatch(raw_line)
+                            if self.logger:
+                                self.logger(raw_line)
+                # End of stream: the Fritzbox closed the connection, close socket to enforce reconnect
+                self.socket.close()
             # socket.py L668: handling errorTab[10051] = "Network is unreachable."
             except OSError as e:
                 log.warning(e)
@@ -204,6 +527,152 @@ class CallMonitor:
                 time.sleep(3)
 
 
+class AsyncCallMonitor:
+    """ Listen to the call monitors of many Fritzboxes, all connections are multiplexed in one asyncio event loop. """
+
+    def __init__(self, hosts, port=1012, autostart=True, logger=None, parser=None, pass_host=False,
+                 reconnect_sec=3, max_reconnect_sec=60):
+        """ Provide a list of hosts (or one host). Parser and logger can be sync functions or coroutine functions,
+        sync ones run in a thread of the default executor, so a slow parser does not stall the other boxes.
+        If pass_host is set, they are called with (raw_line, host) instead of (raw_line) to distinguish the boxes.
+        After a failure a host is reconnected after reconnect_sec, doubled per failure up to max_reconnect_sec. """
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        self.hosts = [host.replace('https://', '').replace('http://', '') for host in hosts]
+        self.port = port
+        self.parser = parser if parser else self.parse_line
+        self.logger = logger
+        self.pass_host = pass_host
+        self.reconnect_sec = reconnect_sec
+        self.max_reconnect_sec = max_reconnect_sec
+        self.reconnects = dict.fromkeys(self.hosts, 0)
+        self.connected = dict.fromkeys(self.hosts, False)
+        self.loop = None
+        self.thread = None
+        self.main_task = None
+        if autostart:
+            self.start()
+
+    def parse_line(self, raw_line, host=None):
+        """ Default parser method for received call monitor lines. """
+        log.debug(raw_line)
+        parsed_line = CallMonitorLine(raw_line)
+        print(parsed_line)
+
+    async def open_connection(self, host):
+        """ Connect a tcp keep-alive socket without blocking, then wrap it into an asyncio stream pair. """
+        loop = asyncio.get_running_loop()
+        sock = create_tcp_keep_alive_socket()
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (host, self.port))
+        except BaseException:
+            sock.close()
+            raise
+        return await asyncio.open_connection(sock=sock)
+
+    async def call_hook(self, hook, raw_line, host):
+        """ Call a sync or async parser/logger. An exception is logged, it must not stop the other boxes.
+        A sync hook runs in the default executor, within a copy of the context, so the current trace is kept. """
+        args = (raw_line, host) if self.pass_host else (raw_line,)
+        try:
+            if inspect.iscoroutinefunction(hook):
+                res = hook(*args)
+            else:
+                context = contextvars.copy_context()
+                res = await asyncio.get_running_loop().run_in_executor(
+                    None, functools.partial(context.run, hook, *args))
+            if inspect.isawaitable(res):
+                await res
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(f'Call monitor {host}: hook failed on line {raw_line.strip()}: {e}')
+
+    async def listen(self, host):
+        """ Listen to the call monitor of one host, reconnect independently of the other hosts. Any error is
+        logged and the host reconnected with backoff, one failing host must not stop the others. """
+        msg = "Call monitor connection {h}:{p} ".format(h=host, p=self.port)
+        delay_sec = self.reconnect_sec
+        while True:
+            writer = None
+            try:
+                reader, writer = await self.open_connection(host)
+                self.connected[host] = True
+                delay_sec = self.reconnect_sec
+                log.info(msg + "established..")
+                while True:
+                    try:
+                        raw = await reader.readline()
+                    except ValueError as e:  # Line longer than the stream limit, the reader skipped it already
+                        log.warning(msg + f"skipped an overlong line: {e}")
+                        continue
+                    if not raw:  # Connection closed by the Fritzbox
+                        break
+                    raw_line = raw.decode('utf-8', errors='replace')
+                    line_type = get_line_type(raw_line)
+                    LINES.inc(line_type)
+                    with tracer.start_trace('callmonitor.line', type=line_type, host=host):
+                        await self.call_hook(self.parser, raw_line, host)
+                    if self.logger:
+                        await self.call_hook(self.logger, raw_line, host)
+            except asyncio.CancelledError:
+                raise
+            except OSError as e:
+                log.warning(msg + f"failed: {e}")
+            except Exception as e:
+                log.exception(msg + f"failed unexpectedly: {e}")
+            finally:
+                self.connected[host] = False
+                if writer:
+                    try:
+                        writer.close()
+                    except Exception as e:
+                        log.debug(msg + f"close failed: {e}")
+            self.reconnects[host] += 1
+            RECONNECTS.inc(host)
+            log.warning(msg + f"closed - reconnecting in {delay_sec}s..")
+            await asyncio.sleep(delay_sec)
+            delay_sec = min(2 * delay_sec, self.max_reconnect_sec)
+
+    async def run(self):
+        """ Listen to all hosts until cancelled. Can be awaited directly if an event loop is already used. """
+        print(f"Call monitor listening started for {len(self.hosts)} host(s)..")
+        try:
+            results = await asyncio.gather(*[self.listen(host) for host in self.hosts], return_exceptions=True)
+            for host, res in zip(self.hosts, results):
+                if isinstance(res, BaseException) and not isinstance(res, asyncio.CancelledError):
+                    log.error(f'Call monitor {host} stopped: {res}')
+        except asyncio.CancelledError:
+            pass
+
+    def start(self):
+        """ Start an own event loop in one background thread, which handles all connections. """
+        self.loop = asyncio.new_event_loop()
+        self.main_task = self.loop.create_task(self.run())
+        self.thread = threading.Thread(target=self.run_loop, daemon=True)
+        self.thread.start()
+
+    def run_loop(self):
+        """ Thread target: run the event loop until all listeners are cancelled. """
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.main_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        """ Stop all connections and the event loop thread. A buffered logger is flushed, but stays open. """
+        log.info("Stop listening..")
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+        if self.thread and self.thread.is_alive():
+            self.thread.join()
+        flush_logger(self.logger)
+
+
 if __name__ == "__main__":
     # Quick example how to use only
 
@@ -211,6 +680,13 @@ if __name__ == "__main__":
     fritzconn = FritzConn()
 
     # Quick example how to use only
-    cm_log = CallMonitorLog(daily=True, anonymize=False)
+    cm_log = CallMonitorLog(daily=True, anonymize=False, buffered=True)
     cm = CallMonitor(host=fritzconn.address, logger=cm_log.log_line)
     # cm.stop()
+
+    # Or replay a recorded log as fast as possible, e.g. through the call blocker
+    # stats = CallMonitorReplay(cm_log.get_log_filepath(), parser=lambda line: None).run(); print(stats)
+
+    # Or listen to several boxes within one thread
+    # acm = AsyncCallMonitor(hosts=[fritzconn.address, '192.168.179.1'], logger=cm_log.log_line)
+    # acm.stop()
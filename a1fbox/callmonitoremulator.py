@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+import heapq
+import logging
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+sys.path.append(os.path.dirname(__file__))
+from callmonitor import CallMonitorType
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
+
+# Weighted prefixes for generated caller numbers: local, other area, mobile, abroad, fake prefix (see CallBlocker)
+DEFAULT_NUMBER_PREFIXES = [('07191', 30), ('0711', 20), ('0175', 25), ('0030', 5), ('0044', 5), ('09460', 5)]
+DEFAULT_OWN_NUMBERS = ['7321234', '6912345']
+DEFAULT_EXTENSIONS = ['10', '11', '13']
+
+
+class EmulatedClient:
+    """ A connected call monitor client, with its planned faults. """
+
+    def __init__(self, client_id, conn, addr, drop_at=None, half_open_at=None):
+        self.client_id = client_id
+        self.conn = conn
+        self.addr = addr
+        self.drop_at = drop_at
+        self.half_open_at = half_open_at
+        self.silent_until = None  # Set if half-open, then nothing is sent anymore
+
+
+class CallMonitorEmulator:
+    """ Local tcp server speaking the call monitor protocol of port 1012, generating calls for load tests. """
+
+    def __init__(self, host='127.0.0.1', port=1012, calls_per_sec=1.0, max_concurrent=10,
+                 answer_ratio=0.6, outgoing_ratio=0.2, clir_ratio=0.05, ring_sec=(1, 5), talk_sec=(5, 120),
+                 numbers=None, own_numbers=None, drop_every_sec=None, half_open_every_sec=None, half_open_sec=30,
+                 drop_with_reset=True, send_timeout_sec=1.0, seed=None, autostart=True):
+        """ Calls start with exponential inter-arrival times at calls_per_sec, at most max_concurrent at once.
+        Numbers are either a callable returning a number, or a list of weighted prefixes like [('0175', 25)].
+        Faults per client connection: drop it every drop_every_sec, or make it half-open (connection stays open,
+        but is silent) every half_open_every_sec for half_open_sec, before it is reset. Durations are jittered.
+        A client not receiving a line within send_timeout_sec is dropped, so it cannot stall the other clients. """
+        self.host = host
+        self.port = port
+        self.calls_per_sec = calls_per_sec
+        self.max_concurrent = max_concurrent
+        self.answer_ratio = answer_ratio
+        self.outgoing_ratio = outgoing_ratio
+        self.clir_ratio = clir_ratio
+        self.ring_sec = ring_sec
+        self.talk_sec = talk_sec
+        self.numbers = numbers if numbers else DEFAULT_NUMBER_PREFIXES
+        self.own_numbers = own_numbers if own_numbers else DEFAULT_OWN_NUMBERS
+        self.drop_every_sec = drop_every_sec
+        self.half_open_every_sec = half_open_every_sec
+        self.half_open_sec = half_open_sec
+        self.drop_with_reset = drop_with_reset
+        self.send_timeout_sec = send_timeout_sec
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.clients = []
+        self.events = []  # Heap of (due_time, seq, event_type, call)
+        self.seq = 0
+        self.free_conn_ids = list(range(max_concurrent - 1, -1, -1))
+        self.pending_drops = dict()  # Client host: deque of (client id, time of drop), to measure reconnect latency
+        self.reconnect_latencies = deque(maxlen=1000)
+        self.calls_started, self.calls_skipped, self.lines_sent, self.bytes_sent = 0, 0, 0, 0
+        self.accepted, self.drops, self.half_opens = 0, 0, 0
+        self.started_at = None
+
+        self.server = None
+        self.do_run = False
+        self.threads = []
+        if autostart:
+            self.start()
+
+    def start(self):
+        """ Open the server socket, start the accepting and the generating thread. """
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.port = self.server.getsockname()[1]  # If port 0 was given, a free port was chosen
+        self.server.listen(16)
+        self.server.settimeout(0.5)
+        self.do_run = True
+        self.started_at = time.time()
+        self.threads = [threading.Thread(target=self.accept_thread, daemon=True),
+                        threading.Thread(target=self.generator_thread, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        log.info(f'Call monitor emulator listening on {self.host}:{self.port}..')
+
+    def stop(self):
+        """ Stop the threads and close all connections. """
+        self.do_run = False
+        for thread in self.threads:
+            thread.join()
+        with self.lock:
+            for client in self.clients:
+                client.conn.close()
+            self.clients = []
+        self.server.close()
+
+    def jitter(self, every_sec):
+        """ Return a due time around every_sec from now, or None if the fault is disabled. """
+        if not every_sec:
+            return None
+        return time.time() + self.random.uniform(0.5, 1.5) * every_sec
+
+    def accept_thread(self):
+        """ Accept clients, e.g. CallMonitor instances. Several clients at once are allowed, like the Fritzbox. """
+        while self.do_run:
+            try:
+                conn, addr = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            now = time.time()
+            conn.settimeout(self.send_timeout_sec)
+            with self.lock:
+                client = EmulatedClient(self.accepted, conn, addr, self.jitter(self.drop_every_sec),
+                                        self.jitter(self.half_open_every_sec))
+                self.clients.append(client)
+                self.accepted += 1
+                # The client port changes on reconnect, so a new connection is the reconnect of the oldest dropped
+                # client of the same host. Several clients on one host, like on localhost, are measured each once.
+                drops = self.pending_drops.get(addr[0])
+                if drops:
+                    _, dropped_at = drops.popleft()
+                    self.reconnect_latencies.append(now - dropped_at)
+
+    def get_number(self):
+        """ Return a random external number, either by callable or by weighted prefixes plus random digits. """
+        if callable(self.numbers):
+            return self.numbers()
+        prefixes, weights = zip(*self.numbers)
+        prefix = self.random.choices(prefixes, weights)[0]
+        return prefix + ''.join(self.random.choice('0123456789') for _ in range(max(3, 11 - len(prefix))))
+
+    def schedule(self, due, event_type, call):
+        heapq.heappush(self.events, (due, self.seq, event_type, call))
+        self.seq += 1
+
+    def start_call(self, due):
+        """ Plan a call as sequence of RING|CALL, optional CONNECT and DISCONNECT events. """
+        if not self.free_conn_ids:
+            self.calls_skipped += 1
+            return
+        self.calls_started += 1
+        outgoing = self.random.random() < self.outgoing_ratio
+        number = self.get_number()
+        if not outgoing and self.random.random() < self.clir_ratio:
+            number = ''  # CLIR, caller uses no number
+        call = {'conn_id': self.free_conn_ids.pop(), 'outgoing': outgoing, 'number': number,
+                'own': self.random.choice(self.own_numbers), 'ext': self.random.choice(DEFAULT_EXTENSIONS),
+                'duration': 0}
+        ring = self.random.uniform(*self.ring_sec)
+        self.schedule(due, CallMonitorType.CALL if outgoing else CallMonitorType.RING, call)
+        if self.random.random() < self.answer_ratio:
+            call['duration'] = round(self.random.uniform(*self.talk_sec))
+            self.schedule(due + ring, CallMonitorType.CONNECT, call)
+            self.schedule(due + ring + call['duration'], CallMonitorType.DISCONNECT, call)
+        else:
+            self.schedule(due + ring, CallMonitorType.DISCONNECT, call)
+
+    @staticmethod
+    def build_line(event_type, call):
+        """ Build a raw line like the Fritzbox does, see log/callmonitor-test.log. """
+        dt = datetime.now().strftime('%d.%m.%y %H:%M:%S')
+        cid = call['conn_id']
+        if event_type == CallMonitorType.RING:
+            return f'{dt};RING;{cid};{call["number"]};{call["own"]};SIP0;\n'
+        elif event_type == CallMonitorType.CALL:
+            return f'{dt};CALL;{cid};{call["ext"]};{call["own"]};{call["number"]};SIP0;\n'
+        elif event_type == CallMonitorType.CONNECT:
+            return f'{dt};CONNECT;{cid};{call["ext"]};{call["number"]};\n'
+        return f'{dt};DISCONNECT;{cid};{call["duration"]};\n'
+
+    def close_client(self, client):
+        """ Drop a client connection, by default with a reset like a rebooting box or broken network. """
+        if self.drop_with_reset:
+            client.conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        client.conn.close()
+        self.drops += 1
+        self.pending_drops.setdefault(client.addr[0], deque(maxlen=1000)).append((client.client_id, time.time()))
+
+    def broadcast(self, raw_line):
+        """ Send a line to all clients which are not half-open. Clients failing to receive within send_timeout_sec
+        are removed. """
+        data = raw_line.encode('utf-8')
+        self.lines_sent += 1
+        with self.lock:
+            for client in list(self.clients):
+                if client.silent_until:
+                    continue
+                try:
+                    client.conn.sendall(data)
+                    self.bytes_sent += len(data)
+                except OSError as e:  # Including socket.timeout, if the client does not read
+                    log.warning(f'Client {client.client_id} {client.addr} removed, sending failed: {e}')
+                    client.conn.close()
+                    self.clients.remove(client)
+
+    def inject_faults(self, now):
+        """ Drop or silence client connections which are due. """
+        with self.lock:
+            for client in list(self.clients):
+                if client.silent_until and now >= client.silent_until:
+                    self.close_client(client)
+                    self.clients.remove(client)
+                elif client.drop_at and now >= client.drop_at:
+                    self.close_client(client)
+                    self.clients.remove(client)
+                elif client.half_open_at and now >= client.half_open_at and not client.silent_until:
+                    client.silent_until = now + self.half_open_sec
+                    self.half_opens += 1
+
+    def generator_thread(self):
+        """ Start calls, emit due events and inject faults, sleeping until the next thing to do. """
+        next_call = time.time()
+        while self.do_run:
+            now = time.time()
+            if self.calls_per_sec > 0:
+                while next_call <= now:
+                    self.start_call(next_call)
+                    next_call += self.random.expovariate(self.calls_per_sec)
+            else:
+                next_call = now + 0.1
+            while self.events and self.events[0][0] <= now:
+                _, _, event_type, call = heapq.heappop(self.events)
+                self.broadcast(self.build_line(event_type, call))
+                if event_type == CallMonitorType.DISCONNECT:
+                    self.free_conn_ids.append(call['conn_id'])
+            self.inject_faults(now)
+            wake = min(next_call, self.events[0][0] if self.events else next_call, now + 0.1)
+            delay = wake - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def get_stats(self):
+        """ Return generated load and measured reconnect latencies of the clients. """
+        elapsed = time.time() - self.started_at if self.started_at else 0
+        latencies = list(self.reconnect_latencies)
+        return {'elapsed_sec': round(elapsed, 3), 'clients': len(self.clients), 'accepted': self.accepted,
+                'calls_started': self.calls_started, 'calls_skipped': self.calls_skipped,
+                'lines_sent': self.lines_sent, 'bytes_sent': self.bytes_sent,
+                'lines_per_sec': round(self.lines_sent / elapsed, 1) if elapsed else 0,
+                'drops': self.drops, 'half_opens': self.half_opens,
+                'reconnect_avg_sec': round(sum(latencies) / len(latencies), 3) if latencies else None,
+                'reconnect_max_sec': round(max(latencies), 3) if latencies else None}
+
+
+if __name__ == "__main__":
+    # Quick example how to use only: load test the call monitor without a Fritzbox
+    from callmonitor import CallMonitor
+
+    emulator = CallMonitorEmulator(port=0, calls_per_sec=200, max_concurrent=100, ring_sec=(0.1, 1),
+                                   talk_sec=(0.1, 2), drop_every_sec=5, half_open_every_sec=8, half_open_sec=2)
+
+    lines = []
+    cm = CallMonitor(host='127.0.0.1', port=emulator.port, parser=lines.append)
+    time.sleep(20)
+    cm.stop()
+    print(f'Call monitor received {len(lines)} lines')
+    print(emulator.get_stats())
+    emulator.stop()
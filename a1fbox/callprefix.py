@@ -1,13 +1,29 @@
 #!/usr/bin/python3
 
 import csv
+import hashlib
 import json
 import logging
+import mmap
 import os
+import struct
+import sys
+import tempfile
+from array import array
+from collections import namedtuple
+from collections.abc import Sequence
 from enum import Enum
 
 from fritzconn import FritzConn
 
+try:
+    import numpy as np  # Optional, vectorizes CallPrefix.get_prefix_arrays for large sets of numbers
+except ImportError:
+    np = None
+
+sys.path.append(os.path.dirname(__file__))
+from utils import DigitTrie, NumberNormalizer
+
 logging.basicConfig(level=logging.WARNING)
 log = logging.getLogger(__name__)
 
@@ -17,6 +33,12 @@ RNB_FILE = os.path.join(os.path.dirname(__file__), '../data/rnb.csv')
 COUNTRY_NAMES_FILE = os.path.join(os.path.dirname(__file__), '../data/countryio-names.json')
 COUNTRY_CODES_FILE = os.path.join(os.path.dirname(__file__), '../data/countryio-phone.json')
 
+# Merged prefix table, compiled from the files above, see CallPrefixSnapshot. This module is a source as well,
+# as it adds prefixes not available as files, and utils, as it defines the layout of the trie nodes.
+SNAPSHOT_FILE = os.path.join(os.path.dirname(__file__), '../data/callprefix.snapshot')
+SNAPSHOT_SOURCES = [ONB_FILE, RNB_FILE, COUNTRY_NAMES_FILE, COUNTRY_CODES_FILE, os.path.abspath(__file__),
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils.py')]
+
 
 class CallPrefixType(Enum):
     """ Distinguish the prefix types. """
@@ -34,6 +56,217 @@ class CallPrefixType(Enum):
     COUNTRY = 99
 
 
+class CallPrefixRecord(namedtuple('CallPrefixRecord', ['code', 'name', 'kind'])):
+    """ A prefix code, like 07191, with its name and CallPrefixType. Fields can also be read like the former dicts,
+    e.g. record['name']. """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key) if isinstance(key, str) else tuple.__getitem__(self, key)
+
+
+class CallPrefixSnapshotRecords(Sequence):
+    """ Records of a snapshot, created on first access from the mapped codes, names and kinds. """
+
+    def __init__(self, offsets, strings, kinds):
+        self.offsets = offsets  # Per record start of code and name in strings, plus the end
+        self.strings = strings
+        self.kinds = kinds
+        self.cache = [None] * len(kinds)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        record = self.cache[index]
+        if record is None:
+            code_start, name_start, end = self.offsets[2 * index], self.offsets[2 * index + 1], \
+                self.offsets[2 * index + 2]
+            record = CallPrefixRecord(str(self.strings[code_start:name_start], 'utf-8'),
+                                      str(self.strings[name_start:end], 'utf-8'), CallPrefixType(self.kinds[index]))
+            self.cache[index] = record
+        return record
+
+
+class CallPrefixSnapshot:
+    """ The merged prefix table compiled into a versioned binary file, which is memory-mapped, so loading takes
+    milliseconds and processes share the pages. Layout: magic, header length, JSON header (version, byte order,
+    sources, sections), then the sections 8 byte aligned: trie nodes (int32), string offsets (int32),
+    kinds (byte per record), codes and names (utf-8), section offsets are relative to the end of the header.
+    Outdated if the size of a source differs, or its mtime and its sha1. If only the mtime differs, the header is
+    rewritten with it, so the sources are not hashed again on every load. """
+
+    MAGIC = b'A1FBPFX\n'
+    VERSION = 1
+
+    @staticmethod
+    def align(position):
+        """ Sections start at multiples of 8, so they can be cast to arrays of ints. """
+        return (position + 7) // 8 * 8
+
+    @staticmethod
+    def get_source_info(path, with_sha1=True):
+        stat = os.stat(path)
+        info = {'path': os.path.basename(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if with_sha1:
+            with open(path, 'rb') as f:
+                info['sha1'] = hashlib.sha1(f.read()).hexdigest()
+        return info
+
+    @staticmethod
+    def is_up_to_date(header, sources):
+        """ Sets the current mtime in the header for sources with a changed mtime but the same sha1. """
+        if header.get('version') != CallPrefixSnapshot.VERSION or header.get('byteorder') != sys.byteorder or \
+                header.get('itemsize') != array('i').itemsize or len(header['sources']) != len(sources):
+            return False
+        for info, path in zip(header['sources'], sources):
+            current = CallPrefixSnapshot.get_source_info(path, with_sha1=False)
+            if info['path'] != current['path'] or info['size'] != current['size']:
+                return False
+            if info['mtime_ns'] != current['mtime_ns']:
+                if info['sha1'] != CallPrefixSnapshot.get_source_info(path)['sha1']:
+                    return False
+                info['mtime_ns'] = current['mtime_ns']
+        return True
+
+    @staticmethod
+    def load(path=SNAPSHOT_FILE, sources=SNAPSHOT_SOURCES):
+        """ Map the snapshot, returns a DigitTrie on it, or None if missing, outdated or broken. """
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # Missing, or empty
+            return None
+        try:
+            if mapped[:len(CallPrefixSnapshot.MAGIC)] != CallPrefixSnapshot.MAGIC:
+                raise ValueError('no prefix snapshot')
+            start = len(CallPrefixSnapshot.MAGIC) + 4
+            header_length, = struct.unpack('<I', mapped[start - 4:start])
+            header = json.loads(mapped[start:start + header_length].decode('utf-8'))
+            mtimes = [info.get('mtime_ns') for info in header['sources']]
+            if not CallPrefixSnapshot.is_up_to_date(header, sources):
+                log.info(f'Prefix snapshot {path} is outdated')
+                return None
+            data_start = CallPrefixSnapshot.align(start + header_length)
+            if mtimes != [info['mtime_ns'] for info in header['sources']]:
+                try:
+                    CallPrefixSnapshot.write(path, header, mapped[data_start:])
+                except OSError as e:  # E.g. a read-only folder, still usable, just hashed again next time
+                    log.warning(f'Prefix snapshot {path} not refreshed: {e}')
+            view = memoryview(mapped)[data_start:]
+            sections = {name: view[offset:offset + length] for name, (offset, length) in header['sections'].items()}
+            records = CallPrefixSnapshotRecords(sections['offsets'].cast('i'), sections['strings'], sections['kinds'])
+            return DigitTrie(nodes=sections['nodes'].cast('i'), values=records)
+        except (ValueError, KeyError, TypeError, struct.error, OSError) as e:
+            log.warning(f'Prefix snapshot {path} is broken: {e}')
+            return None
+
+    @staticmethod
+    def save(trie, path=SNAPSHOT_FILE, sources=SNAPSHOT_SOURCES):
+        """ Write the snapshot atomically, so concurrent processes read either the old or the new one. """
+        offsets, strings = array('i', [0]), bytearray()
+        for record in trie.values:
+            for text in [record.code, record.name]:
+                strings += text.encode('utf-8')
+                offsets.append(len(strings))
+        blobs = {'nodes': array('i', trie.nodes).tobytes(), 'offsets': offsets.tobytes(),
+                 'kinds': bytes(record.kind.value for record in trie.values), 'strings': bytes(strings)}
+        header = {'version': CallPrefixSnapshot.VERSION, 'byteorder': sys.byteorder, 'itemsize': array('i').itemsize,
+                  'sources': [CallPrefixSnapshot.get_source_info(source) for source in sources], 'sections': {}}
+        position = 0
+        for name, blob in blobs.items():
+            header['sections'][name] = [position, len(blob)]
+            position = CallPrefixSnapshot.align(position + len(blob))
+        data = bytearray(position)
+        for name, blob in blobs.items():
+            offset = header['sections'][name][0]
+            data[offset:offset + len(blob)] = blob
+        CallPrefixSnapshot.write(path, header, data)
+
+    @staticmethod
+    def write(path, header, data):
+        """ Write header and sections to a temporary file, replacing the snapshot at once. """
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = CallPrefixSnapshot.align(len(CallPrefixSnapshot.MAGIC) + 4 + len(header_bytes))
+        folder = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.callprefix-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(CallPrefixSnapshot.MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+                f.seek(data_start)
+                f.write(data)
+            os.chmod(temp_path, 0o644)  # Readable by the processes of other users, like a data file
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+class CallPrefixBatchTable:
+    """ The prefix codes per length as int64 keys, to resolve many numbers at once with NumPy. Per length the first
+    digits of all numbers are looked up in one step, longer matches overwrite shorter ones. Lengths up to
+    DENSE_MAX_LENGTH are indexed by dense arrays (key: record index), longer ones by sorted keys and searchsorted. """
+
+    DENSE_MAX_LENGTH = 6  # 10 ** 6 int32, about 4 MB for the 6 digit prefixes, mostly area codes
+
+    def __init__(self, records):
+        self.codes = np.array([record.code for record in records] + [None], dtype=object)  # Last: no match
+        self.names = np.array([record.name for record in records] + [None], dtype=object)
+        self.kinds = np.array([record.kind.value for record in records] + [CallPrefixType.UNKNOWN.value],
+                              dtype=np.int16)
+        by_length = dict()
+        for index, record in enumerate(records):
+            by_length.setdefault(len(record.code), []).append((int(record.code), index))
+        self.max_length = max(by_length) if by_length else 0
+        self.dense, self.sorted = dict(), dict()  # Length: record index per key, or (sorted keys, record indexes)
+        for length, keys_indexes in by_length.items():
+            keys = np.array([key for key, _ in keys_indexes], dtype=np.int64)
+            indexes = np.array([index for _, index in keys_indexes], dtype=np.int32)
+            if length <= self.DENSE_MAX_LENGTH:
+                self.dense[length] = np.full(10 ** length, -1, dtype=np.int32)
+                self.dense[length][keys] = indexes
+            else:
+                order = np.argsort(keys)
+                self.sorted[length] = (keys[order], indexes[order])
+
+    def get_chars(self, numbers, country_code):
+        """ Numbers as matrix of code points, cut to the longest prefix. Own country code replaced by 0 at once. """
+        width = len(country_code) + self.max_length
+        chars = np.asarray(numbers, dtype=f'U{width}').view(np.uint32).reshape(-1, width)
+        cc_length = len(country_code)
+        if cc_length and width > cc_length:
+            cc_chars = np.array([ord(char) for char in country_code], dtype=np.uint32)
+            own = (chars[:, :cc_length] == cc_chars).all(axis=1) & (chars[:, cc_length] != 0)
+            stripped = chars[own]
+            chars[own, 0] = ord('0')
+            chars[own, 1:width - cc_length + 1] = stripped[:, cc_length:]
+            chars[own, width - cc_length + 1:] = 0
+        return chars
+
+    def match(self, numbers, country_code=''):
+        """ Index of the record of the longest prefix per number, len(records) if none matches. """
+        chars = self.get_chars(numbers, country_code)
+        is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+        result = np.full(len(chars), len(self.codes) - 1, dtype=np.int32)
+        keys = np.zeros(len(chars), dtype=np.int64)
+        valid = np.ones(len(chars), dtype=bool)  # All digits so far
+        for length in range(1, self.max_length + 1):
+            valid &= is_digit[:, length - 1]
+            keys *= 10
+            keys += np.where(valid, chars[:, length - 1], ord('0')) - ord('0')
+            if length in self.dense:
+                found = self.dense[length][np.where(valid, keys, 0)]
+                hit = valid & (found >= 0)
+                result[hit] = found[hit]
+            elif length in self.sorted:
+                table_keys, table_indexes = self.sorted[length]
+                positions = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+                hit = valid & (table_keys[positions] == keys)
+                result[hit] = table_indexes[positions[hit]]
+        return result
+
+
 # class CallPrefix:
 #    """ Should a call prefix be an instance of this instead, the other class be renamed to e.g. CallPrefixManager? """
 
@@ -48,10 +281,13 @@ class CallPrefixType(Enum):
 class CallPrefix:
     """ Rename to Manager? Retrieves country code, area code from Fritzbox and provides German area codes plus country codes. """
 
-    def __init__(self, fc):
-        """ Provide a fc = fritz connection, required to retrieve area and country code. """
+    def __init__(self, fc, use_snapshot=True):
+        """ Provide a fc = fritz connection, required to retrieve area and country code. The prefixes are loaded
+        from a snapshot, which is compiled on first use and again if a source changed, see CallPrefixSnapshot. """
         self.fc = fc
-        self.init_prefix_dict()
+        self.warned_outside_germany = False
+        self.batch_table = None  # CallPrefixBatchTable, built on first use
+        self.init_prefix_dict(use_snapshot)
         self.init_area_and_country_code()
 
     def init_area_and_country_code(self):
@@ -60,18 +296,33 @@ class CallPrefix:
         self.area_code = res['NewX_AVM-DE_OKZPrefix'] + res['NewX_AVM-DE_OKZ']
         res = self.fc.call_action('X_VoIP', 'X_AVM-DE_GetVoIPCommonCountryCode')
         self.country_code = res['NewX_AVM-DE_LKZPrefix'] + res['NewX_AVM-DE_LKZ']
+        self.normalizer = NumberNormalizer(self.area_code, self.country_code)
         self.area_code_dict = self.get_prefix_dict(self.area_code)
         self.area_code_name = self.get_prefix_name(self.area_code)
         self.country_code_dict = self.get_prefix_dict(self.country_code)
         self.country_code_name = self.get_prefix_name(self.country_code)
 
     def add_prefix(self, area_code, name, kind):
-        self.prefix_dict[area_code] = {'code': area_code, 'name': name, 'kind': kind}
-
-    def init_prefix_dict(self):
+        self.prefix_dict.add(area_code, CallPrefixRecord(area_code, name, kind))
+        self.batch_table = None
+
+    def init_prefix_dict(self, use_snapshot=True):
+        """ Map the snapshot of the prefixes if up to date, else read the sources and write the snapshot. """
+        self.prefix_dict = CallPrefixSnapshot.load() if use_snapshot else None
+        if self.prefix_dict is not None:
+            return
+        self.read_prefix_sources()
+        if use_snapshot:
+            try:
+                CallPrefixSnapshot.save(self.prefix_dict)
+            except OSError as e:
+                log.warning(f'Could not write prefix snapshot {SNAPSHOT_FILE}: {e}')
+
+    def read_prefix_sources(self):
         """ Read the area codes into a dict. ONB provided by BNetzA as CSV, separated by ';', RNB created manually.
-        And country codes. Detect type by kind. Initialize with German prefix codes not available as JSON/CSV. """
-        self.prefix_dict = dict()
+        And country codes. Detect type by kind. Initialize with German prefix codes not available as JSON/CSV.
+        The prefix_dict is a DigitTrie of CallPrefixRecords, which can be used like a dict by code. """
+        self.prefix_dict = DigitTrie()
 
         # Special prefixes in Germany and later international - taken German wording from:
         # https://www.bundesnetzagentur.de/DE/Sachgebiete/Telekommunikation/Unternehmen_Institutionen/Nummerierung/Rufnummern/Rufnummern_node.html
@@ -191,25 +442,48 @@ class CallPrefix:
             self.add_prefix(code, name, kind)
 
     def get_prefix_dict(self, number):
-        """ Return a dict for a prefix, with code, name, kind (DE_landline, DE_mobile, abroad). """
-        if self.country_code != '0049':
-            log.warning('This method could return wrong prefix names if used outside Germany!')
+        """ Return the record of the longest prefix, with code, name, kind (DE_landline, DE_mobile, abroad), or None.
+        Fields can be read like a dict, e.g. res['name'], or as attributes. """
+        if self.country_code != '0049' and not self.warned_outside_germany:
+            self.warn_outside_germany()
         # "0049" is Germany, but "00497191" should get converted to "07191"
         if number.startswith(self.country_code) and len(number) > len(self.country_code):
-            number = '0' + number.replace(self.country_code, '')
-        # In Germany landline area codes are exclusive, either 3 (030 Berlin), 4 (0201 Essen), but most are 5 digits
-        # (07151 Waiblingen). Mobile area codes can even have 6 digits, e.g. TelcoVillage, but are rare.
-        # Country codes: min 3 digits, like "001", max is Jersey with 8 digits: 00441534. 0035818 has 7 digits.
-        for prefix in [number[:8], number[:7], number[:6], number[:5], number[:4], number[:3]]:
-            if prefix in self.prefix_dict:
-                return self.prefix_dict[prefix]
-        return None
+            number = '0' + number[len(self.country_code):]
+        match = self.prefix_dict.get_longest_match(number)
+        return match[1] if match else None
+
+    def get_prefix_dicts(self, numbers):
+        """ Like get_prefix_dict for many numbers, returns a list of records or None. """
+        return [self.get_prefix_dict(number) for number in numbers]
+
+    def get_prefix_arrays(self, numbers):
+        """ Resolve many numbers, e.g. a call history or spam list, in one call. Returns the codes, names and kinds
+        (CallPrefixType values, UNKNOWN if no prefix) of the longest prefixes. With NumPy these are arrays, computed
+        vectorized for the whole batch, including the country code handling. Without NumPy lists, by lookups.
+        Numbers can be any iterable, like a set or a generator, the results are in its iteration order. """
+        numbers = list(numbers)
+        if np is None:
+            records = self.get_prefix_dicts(numbers)
+            return [record.code if record else None for record in records], \
+                [record.name if record else None for record in records], \
+                [record.kind.value if record else CallPrefixType.UNKNOWN.value for record in records]
+        if self.country_code != '0049' and not self.warned_outside_germany:
+            self.warn_outside_germany()
+        if self.batch_table is None:
+            self.batch_table = CallPrefixBatchTable(self.prefix_dict.values)
+        indexes = self.batch_table.match(numbers, self.country_code)
+        return self.batch_table.codes[indexes], self.batch_table.names[indexes], self.batch_table.kinds[indexes]
+
+    def warn_outside_germany(self):
+        """ Warn once only, not on each lookup. """
+        log.warning('CallPrefix could return wrong prefix names if used outside Germany!')
+        self.warned_outside_germany = True
 
     def get_prefix_name(self, number):
         """ Return name for a prefix, if found, else None. """
-        prefix_dict = self.get_prefix_dict(number)
-        if prefix_dict:
-            return prefix_dict['name']
+        record = self.get_prefix_dict(number)
+        if record:
+            return record.name
         else:
             return None
 
@@ -288,3 +562,21 @@ if __name__ == "__main__":
     res = cp.get_prefix_dict(number)
     assert res['name'] == 'Pitcairn'
     assert res['kind'] == CallPrefixType.COUNTRY
+
+    # Prefixes longer than 8 digits
+    number = "0088351101234"
+    res = cp.get_prefix_dict(number)
+    assert res.name == 'Bandwidth.com'
+    assert res.kind == CallPrefixType.INT_SPECIAL
+
+    # All prefixes below a prefix, and many numbers at once
+    print([record.name for _, record in cp.prefix_dict.walk('008816')])
+    print(cp.get_prefix_dicts(['07191808123', '0175123456', '09460123']))
+    codes, names, kinds = cp.get_prefix_arrays(['07191808123', '004971911234', '0088351101234', '09460123'])
+    assert list(codes) == ['07191', '07191', '008835110', None]
+    assert list(kinds) == [CallPrefixType.DE_LANDLINE.value] * 2 + [CallPrefixType.INT_SPECIAL.value, 0]
+
+    # Any iterable works, e.g. a set of uniqued numbers, results follow its iteration order
+    numbers = {'07191808123', '0175123456', '09460123'}
+    codes, names, kinds = cp.get_prefix_arrays(numbers)
+    assert dict(zip(numbers, codes)) == {'07191808123': '07191', '0175123456': '0175', '09460123': None}
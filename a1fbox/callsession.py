@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+from enum import Enum
+
+sys.path.append(os.path.dirname(__file__))
+from callmonitor import CallMonitorLine, CallMonitorRecord, CallMonitorType
+from utils import datetime_to_epoch
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
+
+
+class CallSessionDirection(Enum):
+    """ Direction of a call, given by the first event: RING is incoming, CALL is outgoing. """
+
+    INCOMING = "INCOMING"
+    OUTGOING = "OUTGOING"
+
+
+class CallSessionStatus(Enum):
+    """ How a call session ended. LOST if no DISCONNECT was received, e.g. after a reconnect of the call monitor. """
+
+    ANSWERED = "ANSWERED"
+    MISSED = "MISSED"  # Incoming call, not answered
+    NOT_REACHED = "NOT_REACHED"  # Outgoing call, not answered
+    LOST = "LOST"
+
+
+class CallSession:
+    """ One call correlated by conn_id, from RING or CALL until DISCONNECT. Times are seconds since epoch. """
+
+    __slots__ = ('conn_id', 'direction', 'caller', 'callee', 'device', 'ext_id',
+                 'start', 'connect', 'end', 'duration', 'last_seen', 'status')
+
+    def __init__(self, conn_id, direction, caller, callee, device, ext_id, start):
+        self.conn_id = conn_id
+        self.direction = direction
+        self.caller, self.callee, self.device, self.ext_id = caller, callee, device, ext_id
+        self.start = start
+        self.connect, self.end, self.duration, self.status = None, None, 0, None
+        self.last_seen = start
+
+    @property
+    def ring_sec(self):
+        """ How long it rang until answered or until given up, None if unknown. """
+        until = self.connect if self.connect is not None else self.end
+        return until - self.start if until is not None else None
+
+    def as_dict(self):
+        return {'conn_id': self.conn_id, 'direction': self.direction.value, 'status': self.status.value,
+                'caller': self.caller, 'callee': self.callee, 'device': self.device, 'ext_id': self.ext_id,
+                'start': self.start, 'connect': self.connect, 'end': self.end,
+                'ring_sec': self.ring_sec, 'duration': self.duration}
+
+    def __str__(self):
+        """ Pretty print a completed call, similar to a call monitor line. """
+        return f'conn_id:{self.conn_id} direction:{self.direction.value} status:{self.status.value} ' \
+               f'caller:{self.caller} callee:{self.callee} ext_id:{self.ext_id} ' \
+               f'ring_sec:{self.ring_sec} duration:{self.duration}'
+
+
+class CallSessionTracker:
+    """ Correlate RING/CALL/CONNECT/DISCONNECT lines by conn_id, emit one completed CallSession per call.
+    Open sessions are kept in insertion order of their last event, so stale ones are found at the front. """
+
+    def __init__(self, on_complete=None, max_sessions=256, timeout_sec=4 * 3600):
+        """ on_complete is called with each completed CallSession. At most max_sessions are open at once, the least
+        recently updated is evicted. Sessions without event for timeout_sec (by line timestamps) are evicted, too. """
+        self.on_complete = on_complete if on_complete else self.print_session
+        self.max_sessions = max_sessions
+        self.timeout_sec = timeout_sec
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.completed, self.lost, self.orphans = 0, 0, 0
+
+    @staticmethod
+    def print_session(session):
+        """ Default callback for completed sessions. """
+        print(session)
+
+    def parse_line(self, raw_line):
+        """ Use as parser for the call monitor, accepts a raw line or a CallMonitorRecord. """
+        if isinstance(raw_line, str):
+            raw_line = CallMonitorLine(raw_line)
+        self.feed(raw_line)
+
+    def feed(self, cm_line):
+        """ Process a CallMonitorLine or CallMonitorRecord, O(1) per event. """
+        epoch = cm_line.epoch if isinstance(cm_line, CallMonitorRecord) else datetime_to_epoch(cm_line.datetime)
+        done = []
+        with self.lock:
+            self.evict_stale(epoch, done)
+            conn_id = cm_line.conn_id
+            if cm_line.type in [CallMonitorType.RING.value, CallMonitorType.CALL.value]:
+                # Same conn_id still open, so its DISCONNECT was missed
+                previous = self.sessions.pop(conn_id, None)
+                if previous:
+                    done.append(self.close(previous, CallSessionStatus.LOST))
+                direction = CallSessionDirection.INCOMING if cm_line.type == CallMonitorType.RING.value \
+                    else CallSessionDirection.OUTGOING
+                self.sessions[conn_id] = CallSession(conn_id, direction, cm_line.caller, cm_line.callee,
+                                                     cm_line.device, cm_line.ext_id, epoch)
+                if len(self.sessions) > self.max_sessions:
+                    _, oldest = self.sessions.popitem(last=False)
+                    done.append(self.close(oldest, CallSessionStatus.LOST))
+            elif cm_line.type == CallMonitorType.CONNECT.value:
+                session = self.sessions.get(conn_id)
+                if session:
+                    session.connect = session.last_seen = epoch
+                    session.ext_id = cm_line.ext_id  # Device which took the call
+                    self.sessions.move_to_end(conn_id)
+                else:
+                    self.orphans += 1
+            elif cm_line.type == CallMonitorType.DISCONNECT.value:
+                session = self.sessions.pop(conn_id, None)
+                if session:
+                    session.end = epoch
+                    session.duration = int(cm_line.duration)
+                    if session.connect is not None:
+                        status = CallSessionStatus.ANSWERED
+                    elif session.direction == CallSessionDirection.INCOMING:
+                        status = CallSessionStatus.MISSED
+                    else:
+                        status = CallSessionStatus.NOT_REACHED
+                    done.append(self.close(session, status))
+                else:
+                    self.orphans += 1
+        # Callbacks outside of the lock, they might be slow
+        for session in done:
+            self.on_complete(session)
+
+    def close(self, session, status):
+        session.status = status
+        if status == CallSessionStatus.LOST:
+            self.lost += 1
+        else:
+            self.completed += 1
+        return session
+
+    def evict_stale(self, now, done):
+        """ Close sessions without event for timeout_sec. Amortized O(1), as the oldest are at the front. """
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.last_seen < self.timeout_sec:
+                break
+            self.sessions.popitem(last=False)
+            done.append(self.close(session, CallSessionStatus.LOST))
+
+    def flush(self):
+        """ Close all open sessions as lost, e.g. when the call monitor is stopped. """
+        with self.lock:
+            done = [self.close(session, CallSessionStatus.LOST) for session in self.sessions.values()]
+            self.sessions.clear()
+        for session in done:
+            self.on_complete(session)
+
+    def get_stats(self):
+        return {'open': len(self.sessions), 'completed': self.completed, 'lost': self.lost, 'orphans': self.orphans}
+
+
+if __name__ == "__main__":
+    # Quick example how to use only: correlate the lines of a recorded log
+    from callmonitor import CallMonitorReplay
+
+    tracker = CallSessionTracker()
+    CallMonitorReplay(os.path.join(os.path.dirname(__file__), '../log/callmonitor-test.log'),
+                      parser=tracker.parse_line).run()
+    tracker.flush()
+    print(tracker.get_stats())
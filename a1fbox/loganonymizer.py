@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.dirname(__file__))
+from logarchive import ARCHIVE_SUFFIX, INDEX_SUFFIX, compress_log_file, iter_archive_lines
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
+
+
+def get_anonymizer(file_name):
+    """ Return the anonymize method for a log file: call blocker logs start with 'callblocker', else call monitor. """
+    if os.path.basename(file_name).startswith('callblocker'):
+        from callblocker import CallBlockerLine
+        return CallBlockerLine.anonymize
+    from callmonitor import CallMonitorLine
+    return CallMonitorLine.anonymize
+
+
+def anonymize_lines(anonymize, src_lines, dst):
+    """ Write the anonymized lines, comments, empty and unparsable lines are skipped, as they could contain
+    numbers. Returns the counts of written and skipped lines. """
+    lines, skipped = 0, 0
+    for line in src_lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            skipped += 1
+            continue
+        try:
+            dst.write(anonymize(stripped + "\n"))
+            lines += 1
+        except (IndexError, ValueError):
+            skipped += 1
+    return lines, skipped
+
+
+def anonymize_file(src_path, dst_path):
+    """ Stream a log file, write an anonymized copy atomically. A compressed archive (.log.blk with .idx, see
+    logarchive) is anonymized into a new archive. Returns the counts of written and skipped lines. """
+    anonymize = get_anonymizer(src_path)
+    is_archive = src_path.endswith(ARCHIVE_SUFFIX)
+    partial_paths = [dst_path + '.tmp']
+    if is_archive:
+        log_path, dst_path = src_path[:-len(ARCHIVE_SUFFIX)], dst_path[:-len(ARCHIVE_SUFFIX)]
+        partial_paths = [dst_path + '.tmp', dst_path,
+                         dst_path + ARCHIVE_SUFFIX + '.tmp', dst_path + INDEX_SUFFIX + '.tmp']
+    try:
+        with open(dst_path + '.tmp', "w", encoding='utf-8') as dst:
+            if is_archive:
+                lines, skipped = anonymize_lines(anonymize, iter_archive_lines(log_path, 0, float('inf')), dst)
+            else:
+                with open(src_path, "r", encoding='utf-8') as src:
+                    lines, skipped = anonymize_lines(anonymize, src, dst)
+        os.replace(dst_path + '.tmp', dst_path)
+        if is_archive:
+            compress_log_file(dst_path)
+    except BaseException:
+        for path in partial_paths:
+            if os.path.exists(path):
+                os.remove(path)  # No partial output next to the logs
+        raise
+    return lines, skipped
+
+
+def anonymize_task(paths):
+    """ Worker entry for the process pool. """
+    src_path, dst_path = paths
+    return (src_path,) + anonymize_file(src_path, dst_path)
+
+
+class LogAnonymizer:
+    """ Anonymize whole log archives in bulk, each file is streamed, the files are spread over a process pool. """
+
+    def __init__(self, workers=None, verbose=True):
+        """ By default uses as many worker processes as CPUs. """
+        self.workers = workers
+        self.verbose = verbose
+
+    def run(self, src_paths, dest_folder):
+        """ Write anonymized copies of the given logs with the same file names into dest_folder. """
+        os.makedirs(dest_folder, exist_ok=True)
+        tasks = []
+        for src_path in src_paths:
+            dst_path = os.path.join(dest_folder, os.path.basename(src_path))
+            if os.path.abspath(dst_path) == os.path.abspath(src_path):
+                raise Exception(f'Refusing to overwrite the original log {src_path}, use another dest_folder!')
+            tasks.append((src_path, dst_path))
+        lines, skipped = 0, 0
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for src_path, file_lines, file_skipped in executor.map(anonymize_task, tasks):
+                lines += file_lines
+                skipped += file_skipped
+                if self.verbose:
+                    print(f'Anonymized {src_path}: lines:{file_lines} skipped:{file_skipped}')
+        seconds = time.perf_counter() - start
+        return {'files': len(tasks), 'lines': lines, 'skipped': skipped, 'seconds': round(seconds, 3),
+                'lines_per_sec': round(lines / seconds, 1) if seconds else 0}
+
+    def run_folder(self, log_folder, dest_folder, file_prefixes=('callmonitor', 'callblocker')):
+        """ Anonymize all .log files and compressed .log.blk archives of the given prefixes within log_folder. """
+        names = sorted(name for name in os.listdir(log_folder)
+                       if name.endswith(('.log', '.log' + ARCHIVE_SUFFIX)) and name.startswith(tuple(file_prefixes)))
+        return self.run([os.path.join(log_folder, name) for name in names], dest_folder)
+
+
+if __name__ == "__main__":
+    # Quick example how to use only: anonymize all logs before sharing them
+    log_folder = os.path.join(os.path.dirname(__file__), "../log")
+    stats = LogAnonymizer().run_folder(log_folder, os.path.join(log_folder, "anonymized"))
+    print(stats)
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+# Compressed archive for closed (daily) log files: the lines are compressed in independent zlib blocks,
+# a sidecar index holds per block the time range and the offset, so a time window is read without
+# decompressing the whole archive. Used by utils.Log, see archive_closed_days and query_raw_lines.
+
+import logging
+import os
+import sys
+import zlib
+
+sys.path.append(os.path.dirname(__file__))
+from utils import get_line_epoch
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIX = '.blk'  # E.g. callmonitor-20200616.log.blk
+INDEX_SUFFIX = '.idx'  # E.g. callmonitor-20200616.log.idx, lines of first_epoch;last_epoch;offset;length;lines
+BLOCK_LINES = 1000
+
+
+def compress_log_file(log_path, block_lines=BLOCK_LINES, remove=True):
+    """ Compress a closed log file into independent blocks of block_lines plus index. Written atomically. """
+    archive_path, index_path = log_path + ARCHIVE_SUFFIX, log_path + INDEX_SUFFIX
+    with open(log_path, "r", encoding='utf-8') as f, \
+            open(archive_path + '.tmp', "wb") as archive, open(index_path + '.tmp', "w") as index:
+        offset = 0
+        block = []
+
+        def write_block():
+            nonlocal offset
+            epochs = [epoch for epoch in map(get_line_epoch, block) if epoch is not None]
+            data = zlib.compress(''.join(block).encode('utf-8'))
+            archive.write(data)
+            first, last = (min(epochs), max(epochs)) if epochs else (0, 0)
+            index.write(f'{first};{last};{offset};{len(data)};{len(block)}\n')
+            offset += len(data)
+            block.clear()
+
+        for line in f:
+            block.append(line)
+            if len(block) >= block_lines:
+                write_block()
+        if block:
+            write_block()
+    os.replace(archive_path + '.tmp', archive_path)
+    os.replace(index_path + '.tmp', index_path)
+    if remove:
+        os.remove(log_path)
+    return archive_path
+
+
+def read_index(log_path):
+    """ Return the blocks of an archive as list of (first_epoch, last_epoch, offset, length, lines). """
+    with open(log_path + INDEX_SUFFIX, "r") as index:
+        return [tuple(int(value) for value in line.split(';')) for line in index if line.strip()]
+
+
+def iter_archive_lines(log_path, start_epoch, end_epoch):
+    """ Yield the lines of an archive within [start_epoch, end_epoch), reading only the overlapping blocks. """
+    with open(log_path + ARCHIVE_SUFFIX, "rb") as archive:
+        for first, last, offset, length, _ in read_index(log_path):
+            if last < start_epoch or first >= end_epoch:
+                continue
+            archive.seek(offset)
+            data = zlib.decompress(archive.read(length)).decode('utf-8')
+            for line in data.splitlines(keepends=True):
+                epoch = get_line_epoch(line)
+                if epoch is not None and start_epoch <= epoch < end_epoch:
+                    yield line
+
+
+def iter_plain_lines(log_path, start_epoch, end_epoch):
+    """ Yield the lines of a not (yet) archived log within [start_epoch, end_epoch), streaming the file. """
+    with open(log_path, "r", encoding='utf-8') as f:
+        for line in f:
+            epoch = get_line_epoch(line)
+            if epoch is not None and start_epoch <= epoch < end_epoch:
+                yield line
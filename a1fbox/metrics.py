@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+
+# Counters and histograms for the long running call monitor/blocker, served in Prometheus text format by a small
+# local HTTP server. Modules create their metrics once at import, updating them costs a lock and a dict update.
+# Like the modules of a1fbox, import it flat (from metrics import registry), a1fbox.metrics would be a 2nd registry.
+
+import logging
+import os
+import sys
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+sys.path.append(os.path.dirname(__file__))
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
+
+# Seconds, from a cached lookup up to a slow provider
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labelnames, labelvalues, extra=''):
+    """ Prometheus label set like {type="RING",host="fritz.box"}, escaped. """
+    pairs = [f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+             for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """ Monotonic counter, optionally per label values, e.g. lines by type. """
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = dict()  # Tuple of label values: value
+        self.lock = threading.Lock()
+
+    def inc(self, *labelvalues, value=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + value
+
+    def get(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [f'{self.name}{format_labels(self.labelnames, labelvalues)} {value}' for labelvalues, value in values]
+
+
+class Histogram:
+    """ Distribution of observed values like latencies in seconds, optionally per label values. """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = dict()  # Tuple of label values: [counts per bucket (+Inf last), sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)  # Bucket is "less or equal"
+        with self.lock:
+            entry = self.values.get(labelvalues)
+            if entry is None:
+                entry = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """ Observe the duration of a with block. """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *labelvalues)
+
+    def get_count(self, *labelvalues):
+        entry = self.values.get(labelvalues)
+        return sum(entry[0]) if entry else 0
+
+    def render(self):
+        with self.lock:
+            values = [(labelvalues, list(counts), total) for labelvalues, (counts, total) in self.values.items()]
+        lines = []
+        for labelvalues, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = format_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """ All metrics of the process, rendered together. Metrics are created once, asking again returns the same. """
+
+    def __init__(self):
+        self.metrics = dict()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def get_or_create(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, *args, **kwargs)
+            elif metric.kind != metric_class.kind:
+                raise Exception(f'Metric {name} exists already as {metric.kind}!')
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.get_or_create(Counter, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.get_or_create(Histogram, name, help_text, labelnames, buckets)
+
+    def render(self):
+        """ All metrics in Prometheus text format. """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self, port=9123, host='127.0.0.1'):
+        """ Serve GET /metrics by a background thread, only locally by default. """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/metrics', '/']:
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f'Metrics served on http://{host}:{self.server.server_port}/metrics')
+        return self.server
+
+    def stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+registry = MetricsRegistry()  # Default registry, used by all modules
+
+
+if __name__ == "__main__":
+    # Quick example how to use only
+    lines = registry.counter('example_lines_total', 'Lines by type', ['type'])
+    latency = registry.histogram('example_latency_seconds', 'Latency of something')
+    lines.inc('RING')
+    with latency.time():
+        pass
+    print(registry.render())
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+from time import monotonic, sleep
+from urllib.parse import quote
+
+import requests
+
+sys.path.append(os.path.dirname(__file__))
+
+sys.path.append("..")
+try:
+    from config import TELEGRAM_BOT_URL
+except ImportError:
+    TELEGRAM_BOT_URL = ""
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
+
+
+class Notifier:
+    """ Post messages to a URL like the Telegram bot's by a background thread, so a slow or unreachable endpoint
+    never delays the call handling. Messages with the same key are posted once within dedup_sec, messages queued
+    meanwhile (e.g. during a burst) are batched into one post. """
+
+    def __init__(self, url=TELEGRAM_BOT_URL, prefix='', dedup_sec=60, max_batch=10, batch_sec=0.0,
+                 retries=2, retry_sec=1.0, timeout_sec=5, max_queue=1000):
+        """ The message is appended url encoded to the url. A post is retried up to retries times, waiting retry_sec,
+        doubled each time. If more than max_queue messages are waiting, new ones are dropped.
+        By batch_sec a post can wait for more messages to batch, by default only the queued ones are batched. """
+        self.url = url
+        self.prefix = prefix
+        self.dedup_sec = dedup_sec
+        self.max_batch = max_batch
+        self.batch_sec = batch_sec
+        self.retries = retries
+        self.retry_sec = retry_sec
+        self.timeout_sec = timeout_sec
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.session = requests.Session()  # Reuses the connection
+        self.lock = threading.Lock()
+        self.last_posted = dict()  # Key: monotonic time of last notify
+        self.posted, self.batches, self.deduped, self.dropped, self.failed = 0, 0, 0, 0, 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.post_thread, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def notify(self, message, key=None):
+        """ Queue a message, never blocks. Returns False if it was deduplicated by key or dropped. """
+        if self.closed:
+            return False
+        if key is not None:
+            now = monotonic()
+            with self.lock:
+                if now - self.last_posted.get(key, -self.dedup_sec) < self.dedup_sec:
+                    self.deduped += 1
+                    return False
+                self.last_posted[key] = now
+                if len(self.last_posted) > 10 * self.queue.maxsize:  # Forget outdated keys once in a while
+                    self.last_posted = {k: t for k, t in self.last_posted.items() if now - t < self.dedup_sec}
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            log.warning('Notification queue is full, message dropped')
+            return False
+
+    def get_batch(self):
+        """ Wait for a message, add the ones queued meanwhile up to max_batch. None is the stop signal. """
+        messages = [self.queue.get()]
+        deadline = monotonic() + self.batch_sec
+        while messages[-1] is not None and len(messages) < self.max_batch:
+            try:
+                remaining = deadline - monotonic()
+                messages.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def post_thread(self):
+        while True:
+            messages = self.get_batch()
+            stop = messages[-1] is None
+            messages = [message for message in messages if message is not None]
+            if messages:
+                self.post(messages)
+            if stop:
+                break
+
+    def post(self, messages):
+        """ Post the messages as one, with bounded retries. """
+        text = self.prefix + "\n".join(message.strip() for message in messages)
+        wait_sec = self.retry_sec
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(self.url + quote(text), timeout=self.timeout_sec)
+                response.raise_for_status()
+                self.posted += len(messages)
+                self.batches += 1
+                return True
+            except requests.exceptions.RequestException as e:
+                if attempt == self.retries or self.closed:
+                    log.warning(f'Notification failed, {len(messages)} messages lost: {e}')
+                    break
+                sleep(wait_sec)
+                wait_sec *= 2
+        self.failed += len(messages)
+        return False
+
+    def close(self, timeout_sec=10):
+        """ Stop the thread after posting the queued messages, waits at most timeout_sec. """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put(None, timeout=timeout_sec)
+        except queue.Full:
+            pass
+        self.thread.join(timeout_sec)
+        self.session.close()
+
+    def get_stats(self):
+        return {'queued': self.queue.qsize(), 'posted': self.posted, 'batches': self.batches,
+                'deduped': self.deduped, 'dropped': self.dropped, 'failed': self.failed}
+
+
+if __name__ == "__main__":
+    # Quick example how to use only, needs TELEGRAM_BOT_URL in config.py
+    notifier = Notifier(prefix='Notifier: ')
+    for i in range(5):
+        notifier.notify(f'test message {i}', key='test')  # Posted once only
+    notifier.notify('another test message')
+    notifier.close()
+    print(notifier.get_stats())
@@ -1,20 +1,40 @@
 #!/usr/bin/python3
 
+import hashlib
+import json
 import logging
+import re
+from time import perf_counter
+from xml.sax.saxutils import escape
 
-from fritzconnection.lib.fritzphonebook import FritzPhonebook
+from fritzconnection.core.utils import get_content_from
+from fritzconnection.lib.fritzphonebook import FritzPhonebook, SERVICE
 
 from fritzconn import FritzConn
+from metrics import registry
+from tracing import tracer
 
 logging.basicConfig(level=logging.WARNING)
 log = logging.getLogger(__name__)
 
 KEEP_INTERNALS = False
 
+REFRESH_SECONDS = registry.histogram('a1fbox_phonebook_refresh_seconds',
+                                     'Time to refresh a phonebook, by parsed (no if unchanged)', ['parsed'])
+
 
 class Phonebook(FritzPhonebook):
     """ Unless PR #56 is merged, inherit and extend for required changes. """
 
+    def call_action(self, service, actionname, **kwargs):
+        """ Call a SOAP action of the Fritzbox, traced as e.g. phonebook.SetPhonebookEntry. """
+        with tracer.span(f'phonebook.{actionname}'):
+            return self.fc.call_action(service, actionname, **kwargs)
+
+    def _action(self, actionname, **kwargs):
+        """ Actions of the base class, like GetPhonebook, are traced as well. """
+        return self.call_action(SERVICE, actionname, **kwargs)
+
     def get_all_contacts(self, id, keep_internals=KEEP_INTERNALS):
         """
         Get a list of contacts for the phonebook with `id`.
@@ -22,6 +42,10 @@ class Phonebook(FritzPhonebook):
         """
         url = self.phonebook_info(id)['url']
         self._read_phonebook(url)
+        return self.get_read_contacts(keep_internals)
+
+    def get_read_contacts(self, keep_internals=KEEP_INTERNALS):
+        """ Contacts of the phonebook read before, remove internal numbers like 'Wecker' by keep_internals=False. """
         return [contact for contact in self.phonebook.contacts if
                 keep_internals or not contact.numbers[0].startswith('**')]
 
@@ -31,11 +55,13 @@ class Phonebook(FritzPhonebook):
         phonebook with `id`.
         Remove internal numbers like 'Wecker' by keep_internals=False.
         """
-        url = self.phonebook_info(id)['url']
-        self._read_phonebook(url)
-        # Add suffix _ for same named entries, 1st dup _, 2nd dup __ etc.
+        return self.get_names_of_contacts(self.get_all_contacts(id, keep_internals))
+
+    @staticmethod
+    def get_names_of_contacts(contacts):
+        """ Add suffix _ for same named entries, 1st dup _, 2nd dup __ etc. """
         name_dict = dict()
-        for contact in self.get_all_contacts(id, keep_internals):
+        for contact in contacts:
             name = contact.name
             while name in name_dict:
                 name += '_'
@@ -48,30 +74,67 @@ class Phonebook(FritzPhonebook):
         for the phonebook with `id`.
         Remove internal numbers like 'Wecker' by keep_internals=False.
         """
+        return self.get_numbers_of_names(self.get_all_names(id, keep_internals))
+
+    @staticmethod
+    def get_numbers_of_names(name_dict):
         reverse_contacts = dict()
-        for name, numbers in self.get_all_names(id, keep_internals).items():
+        for name, numbers in name_dict.items():
             for number in numbers:
                 # A number can contain spaces, e.g. like "<area code> <number>"
                 nr = number.replace(' ', '')
                 reverse_contacts[nr] = name
         return reverse_contacts
 
+    def get_all_numbers_if_changed(self, id, marker=None, keep_internals=KEEP_INTERNALS):
+        """ Download the phonebook with `id`, but parse it only if its change marker differs from the given one.
+        The marker is the modification timestamp of the phonebook, or a content hash if there is none.
+        A timestamp is passed to the phonebook URL (&timestamp=), then the Fritzbox answers an unchanged phonebook
+        without its contacts, so only the small header is transferred. Returns (marker, number_name_dict),
+        the dict is None if unchanged. """
+        start = perf_counter()
+        url = self.phonebook_info(id)['url']
+        if marker and marker.isdigit():
+            url += ('&' if '?' in url else '?') + f'timestamp={marker}'
+        with tracer.span('phonebook.download', id=id):
+            content = get_content_from(url, timeout=self.fc.timeout, session=self.fc.session)
+        match = re.search(r'<timestamp>(\d+)</timestamp>', content)
+        new_marker = match.group(1) if match else hashlib.sha1(content.encode('utf-8')).hexdigest()
+        if new_marker == marker:
+            REFRESH_SECONDS.observe(perf_counter() - start, 'no')
+            return marker, None
+        with tracer.span('phonebook.parse', id=id):
+            self._read_phonebook(content.strip())
+            numbers = self.get_numbers_of_names(self.get_names_of_contacts(self.get_read_contacts(keep_internals)))
+        REFRESH_SECONDS.observe(perf_counter() - start, 'yes')
+        return new_marker, numbers
+
+    @staticmethod
+    def get_contact_xml(name, numbers, category=0, uniqueid=None):
+        """ Contact as expected by SetPhonebookEntry(UID), with uniqueid an existing entry is updated. """
+        numbers_xml = ''.join(f'<number type="home" prio="{1 if i == 0 else 0}" id="{i}">{escape(number)}</number>'
+                              for i, number in enumerate(numbers))
+        uniqueid_xml = f'<uniqueid>{escape(str(uniqueid))}</uniqueid>' if uniqueid is not None else ''
+        return (f'<?xml version="1.0" encoding="utf-8"?>'
+                f'<Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope"'
+                f' s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+                f'<contact>'
+                f'<category>{escape(str(category))}</category>'
+                f'<person><realName>{escape(name)}</realName></person>'
+                f'<telephony nid="{len(numbers)}">{numbers_xml}</telephony>'
+                f'{uniqueid_xml}'
+                f'</contact>'
+                f'</Envelope>')
+
     def add_contact(self, pb_id, name, number, skip_existing=True):
-        """ Bad style, but works. Should use a fritzconnection's Contact object and Soaper later. """
+        """ Add a contact with one number. If skip_existing, the phonebook is read to check if the number exists
+        already. """
 
         # Idea: could additionally remove spaces like "<area code> <number>" and prevent to add no-numbers like "808xxx"
 
         arg = {'NewPhonebookID': pb_id,
                'NewPhonebookEntryID': '',
-               'NewPhonebookEntryData':
-                   f'<?xml version="1.0" encoding="utf-8"?>'
-                   f'<Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
-                   f'<contact>'
-                   f'<category>0</category>'
-                   f'<person><realName>{name}</realName></person>'
-                   f'<telephony nid="1"><number type="home" prio="1" id="0">{number}</number></telephony>'
-                   f'</contact>'
-                   f'</Envelope>'}
+               'NewPhonebookEntryData': self.get_contact_xml(name, [number])}
 
         if skip_existing:
             pb_number_to_name = self.get_all_numbers(pb_id)  # [{Number: Name}, ..]
@@ -80,15 +143,15 @@ class Phonebook(FritzPhonebook):
                 return {}
 
         # If {} == success, it was added, then reload phonebook, otherwise would try to re-add for next rings again
-        return self.fc.call_action('X_AVM-DE_OnTel:1', 'SetPhonebookEntry', arguments=arg)
+        return self.call_action('X_AVM-DE_OnTel:1', 'SetPhonebookEntry', arguments=arg)
 
     def get_handset_info(self, keep_phone_only=False):
         """ Idea: retrieve internal handset assignments and their numbers."""
-        res = self.fc.call_action('X_AVM-DE_OnTel:1', 'GetDECTHandsetList')
+        res = self.call_action('X_AVM-DE_OnTel:1', 'GetDECTHandsetList')
         ids = res['NewDectIDList'].split(',')
         dect_set = set()
         for id in ids:
-            res = self.fc.call_action('X_AVM-DE_OnTel:1', 'GetDECTHandsetInfo', arguments={'NewDectId': id})
+            res = self.call_action('X_AVM-DE_OnTel:1', 'GetDECTHandsetInfo', arguments={'NewDectId': id})
             entry = res['NewHandsetName']
             if keep_phone_only:
                 entry = entry.split(' ')[1]
@@ -96,26 +159,122 @@ class Phonebook(FritzPhonebook):
         return dect_set
 
     def get_voip_clients(self):
-        return self.fc.call_action('X_VoIP:1', 'X_AVM-DE_GetNumberOfClients')
+        return self.call_action('X_VoIP:1', 'X_AVM-DE_GetNumberOfClients')
 
     def get_voip_numbers(self):
-        return self.fc.call_action('X_VoIP:1', 'X_AVM-DE_GetNumbers')['NewNumberList']
+        return self.call_action('X_VoIP:1', 'X_AVM-DE_GetNumbers')['NewNumberList']
+
+    @staticmethod
+    def contact_to_dict(contact):
+        """ A fritzconnection Contact as dict, as used for json import/export. """
+        return {'name': contact.name, 'numbers': [number.replace(' ', '') for number in contact.numbers],
+                'category': contact.category, 'uniqueid': contact.uniqueid}
 
     def update_contact(self, pb_id, contact):
-        """ Idea: could use contact.uniqueid to update corresponding record in Fritz!Box phonebook with pb_id. """
-        raise NotImplementedError()
+        """ Update the record with contact's uniqueid in phonebook pb_id, contact is a Contact or a dict. """
+        if not isinstance(contact, dict):
+            contact = self.contact_to_dict(contact)
+        arg = {'NewPhonebookID': pb_id,
+               'NewPhonebookEntryData': self.get_contact_xml(contact['name'], contact['numbers'],
+                                                             contact.get('category') or 0, contact['uniqueid'])}
+        return self.call_action('X_AVM-DE_OnTel:1', 'SetPhonebookEntryUID', arguments=arg)
 
     def delete_contact(self, pb_id, contact):
-        """ Idea: could use contact.uniqueid to delete corresponding record in Fritz!Box phonebook with pb_id. """
-        raise NotImplementedError()
-
-    def import_contacts_from_json(self, pb_id, json_file, skip_existing=True):
-        """ Idea: could use a json file with a list of contact dict to populate a phonebook with pb_id. """
-        raise NotImplementedError()
-
-    def export_contacts_to_json(self, pb_id, json_file):
-        """ Idea: could export a phonebook with pb_id to a json file with a list of contact dict. """
-        raise NotImplementedError()
+        """ Delete the record with contact's uniqueid in phonebook pb_id, contact is a Contact or a dict. """
+        uniqueid = contact['uniqueid'] if isinstance(contact, dict) else contact.uniqueid
+        arg = {'NewPhonebookID': pb_id, 'NewPhonebookEntryUniqueID': uniqueid}
+        return self.call_action('X_AVM-DE_OnTel:1', 'DeletePhonebookEntryUID', arguments=arg)
+
+    def get_sync_actions(self, existing, contacts, skip_existing=True, delete_missing=False):
+        """ Diff contact dicts against the existing ones, matched by any of their numbers.
+        Returns lists of contacts to add, to update (with uniqueid of the match) and to delete, the conflicts:
+        contacts matching an existing one which was matched by a previous contact already, they are not synced,
+        and the counts of the contacts left alone: unchanged, skipped (no number, or changed but skip_existing)
+        and duplicate (a number given by a previous contact of the input already). """
+        by_number = dict()
+        for contact in existing:
+            for number in contact['numbers']:
+                by_number.setdefault(number, contact)
+        to_add, to_update, conflicts, matched, seen = [], [], [], set(), set()
+        counts = {'unchanged': 0, 'skipped': 0, 'duplicate': 0}
+        for contact in contacts:
+            numbers = [number.replace(' ', '') for number in contact['numbers']]
+            if not numbers:
+                counts['skipped'] += 1
+                continue
+            if any(number in seen for number in numbers):
+                counts['duplicate'] += 1
+                continue
+            seen.update(numbers)
+            match = next((by_number[number] for number in numbers if number in by_number), None)
+            if not match:
+                to_add.append(dict(contact, numbers=numbers))
+                continue
+            if match['uniqueid'] in matched:
+                log.warning(f'{contact["name"]} matches {match["name"]}, which is matched already, skipped..')
+                conflicts.append(dict(contact, numbers=numbers))
+                continue
+            matched.add(match['uniqueid'])
+            category = contact.get('category', match['category'])
+            changed = contact['name'] != match['name'] or sorted(numbers) != sorted(match['numbers']) \
+                or str(category) != str(match['category'])
+            if not changed:
+                counts['unchanged'] += 1
+            elif skip_existing:
+                counts['skipped'] += 1
+            else:
+                to_update.append(dict(contact, numbers=numbers, category=category, uniqueid=match['uniqueid']))
+        to_delete = [contact for contact in existing if contact['uniqueid'] not in matched] if delete_missing else []
+        return to_add, to_update, to_delete, conflicts, counts
+
+    def sync_contacts(self, pb_id, contacts, skip_existing=True, delete_missing=False, progress=None):
+        """ Bring the phonebook pb_id in line with a list of contact dicts (name, numbers, optionally category).
+        The phonebook is read once, only the needed add, update (if not skip_existing) and delete (if delete_missing)
+        actions are sent. Internal numbers are never touched. progress is called with (done, total, action, contact).
+        Returns the counts per action, conflicts and the contacts left alone are counted, see get_sync_actions. """
+        self.get_all_contacts(pb_id)
+        existing = [self.contact_to_dict(contact) for contact in self.get_read_contacts(keep_internals=False)]
+        to_add, to_update, to_delete, conflicts, counts = self.get_sync_actions(existing, contacts, skip_existing,
+                                                                                delete_missing)
+        actions = [('add', contact) for contact in to_add] + [('update', contact) for contact in to_update] \
+            + [('delete', contact) for contact in to_delete]
+        stats = dict({'add': 0, 'update': 0, 'delete': 0, 'failed': 0, 'conflict': len(conflicts)}, **counts)
+        for done, (action, contact) in enumerate(actions, 1):
+            try:
+                if action == 'add':
+                    arg = {'NewPhonebookID': pb_id, 'NewPhonebookEntryID': '',
+                           'NewPhonebookEntryData': self.get_contact_xml(contact['name'], contact['numbers'],
+                                                                         contact.get('category') or 0)}
+                    self.call_action('X_AVM-DE_OnTel:1', 'SetPhonebookEntry', arguments=arg)
+                elif action == 'update':
+                    self.update_contact(pb_id, contact)
+                else:
+                    self.delete_contact(pb_id, contact)
+                stats[action] += 1
+            except Exception as e:
+                log.warning(f'Phonebook {action} of {contact["name"]} failed: {e}')
+                stats['failed'] += 1
+            if progress:
+                progress(done, len(actions), action, contact)
+        return stats
+
+    def import_contacts_from_json(self, pb_id, json_file, skip_existing=True, delete_missing=False, progress=None):
+        """ Populate a phonebook with pb_id from a json file with a list of contact dicts, see sync_contacts. """
+        with open(json_file, "r", encoding='utf-8') as f:
+            contacts = json.load(f)
+        return self.sync_contacts(pb_id, contacts, skip_existing, delete_missing, progress)
+
+    def export_contacts_to_json(self, pb_id, json_file, keep_internals=KEEP_INTERNALS):
+        """ Export a phonebook with pb_id to a json file with a list of contact dicts, one contact per line
+        is written. Returns the count of exported contacts. """
+        count = 0
+        with open(json_file, "w", encoding='utf-8') as f:
+            f.write('[')
+            for contact in self.get_all_contacts(pb_id, keep_internals):
+                f.write((',\n' if count else '\n') + json.dumps(self.contact_to_dict(contact), ensure_ascii=False))
+                count += 1
+            f.write('\n]\n')
+        return count
 
     def ensure_pb_ids_valid(self, pb_ids):
         """ Checks a list of phonebook ids. Raise if a phonebook id does not exist. """
@@ -133,14 +292,15 @@ class Phonebook(FritzPhonebook):
         return number_name_dict
 
     def get_name_for_number_in_dict(self, number, number_name_dict, area_code=None, country_code=None):
-        """ Return first name found for a number_name_dict. Can also find it with/without area or country code. """
+        """ Return first name found for a number_name_dict. Can also find it with/without area or country code.
+        If many numbers are looked up, better key the dict by utils.NumberNormalizer, it's one probe then. """
 
         numbers = [number]
 
         # Try also to find a phonebook entry with or without the country_code
         if country_code:
             if number.startswith(country_code):
-                numbers.append(number.replace(country_code, '0'))  # E.g.: 00497191 => 07191
+                numbers.append('0' + number[len(country_code):])  # E.g.: 00497191 => 07191
             else:
                 numbers.append(country_code + number)
 
@@ -148,15 +308,15 @@ class Phonebook(FritzPhonebook):
         if area_code:
             nr = number
             if country_code and number.startswith(country_code):
-                nr = number.replace(country_code, '0')
+                nr = '0' + number[len(country_code):]
             if nr.startswith(area_code):
-                numbers.append(nr.replace(area_code, ''))
+                numbers.append(nr[len(area_code):])
             else:
                 numbers.append(area_code + nr)
 
         # Return first match, or None if not found
         for number in numbers:
-            if number in number_name_dict.keys():
+            if number in number_name_dict:
                 return number_name_dict[number]
         return None
 
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+from time import time, sleep
+
+try:
+    import fcntl  # To share the buckets between processes, not available e.g. on Windows
+except ImportError:
+    fcntl = None
+
+sys.path.append(os.path.dirname(__file__))
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
+
+PROVIDER_TELLOWS = 'tellows'
+PROVIDER_DASOERTLICHE = 'dasoertliche'
+PROVIDER_WEMGEHOERT = 'wemgehoert'
+
+# Per provider: requests per interval_sec, burst. Too many requests are answered by captchas or blocks
+DEFAULT_RATES = {PROVIDER_TELLOWS: (15, 60, 3), PROVIDER_DASOERTLICHE: (15, 60, 3), PROVIDER_WEMGEHOERT: (4, 60, 1)}
+
+
+def get_default_state_folder():
+    """ Per user, so another user cannot block or spoil the state: below XDG_RUNTIME_DIR if set, else in the
+    temp folder with the uid in the name. """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'a1fbox-ratelimit')
+    user = os.getuid() if hasattr(os, 'getuid') else os.environ.get('USERNAME', 'user')
+    return os.path.join(tempfile.gettempdir(), f'a1fbox-ratelimit-{user}')
+
+
+DEFAULT_STATE_FOLDER = get_default_state_folder()
+
+
+class TokenBucket:
+    """ Allow `requests` per interval_sec, up to burst at once. A request takes a token, tokens are refilled
+    continuously. If a state file is given, the bucket is shared with other processes, locked by flock. """
+
+    def __init__(self, name, requests, interval_sec, burst=1, state_path=None):
+        self.name = name
+        self.rate_per_sec = requests / interval_sec
+        self.burst = burst
+        self.state_path = state_path if fcntl else None
+        self.lock = threading.Lock()
+        self.tokens, self.last = burst, time()  # State, if not shared by file
+        self.acquired, self.waited, self.rejected, self.waited_sec = 0, 0, 0, 0.0
+
+    def load(self, f):
+        """ Read tokens and time of last update, a missing or broken state means a full bucket. """
+        f.seek(0)
+        try:
+            tokens, last = f.read().split(';')
+            return float(tokens), float(last)
+        except ValueError:
+            return self.burst, time()
+
+    @staticmethod
+    def save(f, tokens, last):
+        f.seek(0)
+        f.truncate()
+        f.write(f'{tokens};{last}')
+        f.flush()
+
+    def reserve(self, timeout_sec):
+        """ Take a token, which may become available in the future only. Returns the seconds to wait for it,
+        or None if that would take longer than timeout_sec. If the state file fails, the bucket falls back to
+        the state of this process, a rate limit must never break the call screening. """
+        with self.lock:
+            if self.state_path:
+                try:
+                    with open(self.state_path, 'a+') as f:
+                        fcntl.flock(f, fcntl.LOCK_EX)
+                        try:
+                            return self.reserve_token(timeout_sec, *self.load(f),
+                                                      lambda tokens, last: self.save(f, tokens, last))
+                        finally:
+                            fcntl.flock(f, fcntl.LOCK_UN)
+                except OSError as e:
+                    log.warning(f'Rate limit state {self.state_path} failed, not shared with other processes: {e}')
+                    self.state_path = None
+            return self.reserve_token(timeout_sec, self.tokens, self.last, self.set_state)
+
+    def set_state(self, tokens, last):
+        self.tokens, self.last = tokens, last
+
+    def reserve_token(self, timeout_sec, tokens, last, set_state):
+        now = time()
+        tokens = min(self.burst, tokens + max(0.0, now - last) * self.rate_per_sec)
+        wait_sec = max(0.0, (1 - tokens) / self.rate_per_sec)  # Negative tokens are reserved by other requests
+        if timeout_sec is not None and wait_sec > timeout_sec:
+            set_state(tokens, now)
+            return None
+        set_state(tokens - 1, now)
+        return wait_sec
+
+    def acquire(self, timeout_sec=None):
+        """ Wait until a request is allowed. Returns False without waiting if it is not allowed within timeout_sec. """
+        wait_sec = self.reserve(timeout_sec)
+        if wait_sec is None:
+            self.rejected += 1
+            return False
+        if wait_sec:
+            self.waited += 1
+            self.waited_sec += wait_sec
+            sleep(wait_sec)
+        self.acquired += 1
+        return True
+
+    def get_stats(self):
+        return {'acquired': self.acquired, 'waited': self.waited, 'rejected': self.rejected,
+                'waited_sec': round(self.waited_sec, 3)}
+
+
+class RateLimiter:
+    """ One token bucket per provider, shared by all threads. By default shared by all processes on this host
+    as well, e.g. the live call blocker and a batch job like calllist.py, so they do not exceed a quota together. """
+
+    def __init__(self, rates=None, state_folder=DEFAULT_STATE_FOLDER, shared=True):
+        """ Rates are a dict of provider: (requests, interval_sec, burst), see DEFAULT_RATES. """
+        rates = rates if rates else DEFAULT_RATES
+        if shared and fcntl:
+            try:
+                os.makedirs(state_folder, mode=0o700, exist_ok=True)
+            except OSError as e:
+                log.warning(f'Rate limit state folder {state_folder} failed, not shared with other processes: {e}')
+                shared = False
+        elif shared:
+            log.warning('No fcntl on this platform, rate limits are shared by the threads of this process only')
+        self.buckets = dict()
+        for provider, (requests, interval_sec, burst) in rates.items():
+            state_path = os.path.join(state_folder, f'{provider}.state') if shared else None
+            self.buckets[provider] = TokenBucket(provider, requests, interval_sec, burst, state_path)
+
+    def acquire(self, provider, timeout_sec=None):
+        """ Wait until a request to provider is allowed, False if not within timeout_sec. Unknown providers
+        are not limited. """
+        bucket = self.buckets.get(provider)
+        return bucket.acquire(timeout_sec) if bucket else True
+
+    def get_stats(self):
+        return {provider: bucket.get_stats() for provider, bucket in self.buckets.items()}
+
+
+if __name__ == "__main__":
+    # Quick example how to use only: 3 at once, then one every 2 seconds, run it twice at the same time
+    limiter = RateLimiter(rates={'test': (1, 2, 3)})
+    for i in range(6):
+        limiter.acquire('test')
+        print(f'{time():.1f} request {i}')
+    print(limiter.get_stats())
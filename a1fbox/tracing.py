@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+# Lightweight tracing: each sampled call monitor line gets a trace, the modules record timed child spans like
+# callblocker.examine, callinfo.tellows or phonebook.SetPhonebookEntry. The current span is kept in a contextvar,
+# so spans of different threads and asyncio tasks do not mix. If a line is not sampled, a span costs one lookup.
+# Like the modules of a1fbox, import it flat (from tracing import tracer), a1fbox.tracing would be a 2nd tracer.
+
+import contextvars
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from time import time, perf_counter
+
+sys.path.append(os.path.dirname(__file__))
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
+
+current_span = contextvars.ContextVar('a1fbox_current_span', default=None)
+span_ids = itertools.count(1)
+no_span = nullcontext()
+
+
+class Span:
+    """ A timed step of a trace, e.g. one provider request. """
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start', 'start_counter', 'duration', 'attrs')
+
+    def __init__(self, trace, name, parent_id=None, attrs=None):
+        self.trace = trace
+        self.span_id = next(span_ids)
+        self.parent_id = parent_id
+        self.name = name
+        self.start, self.start_counter = time(), perf_counter()
+        self.duration = None
+        self.attrs = attrs if attrs else dict()
+        trace.open_span(self)
+
+    def end(self):
+        if self.duration is None:
+            self.duration = perf_counter() - self.start_counter
+            self.trace.close_span()
+
+    def as_dict(self):
+        return {'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name, 'start': self.start,
+                'duration_ms': round(1000 * self.duration, 3) if self.duration is not None else None,
+                'attrs': self.attrs}
+
+
+class Trace:
+    """ All spans of one call monitor line. Finished when all spans ended, also the ones in background threads. """
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.trace_id = os.urandom(8).hex()
+        self.spans = []
+        self.open = 0
+        self.lock = threading.Lock()
+
+    def open_span(self, span):
+        with self.lock:
+            self.spans.append(span)
+            self.open += 1
+
+    def hold(self):
+        """ Keep the trace open for a span to be opened later, e.g. in an executor, released by close_span. """
+        with self.lock:
+            self.open += 1
+
+    def close_span(self):
+        with self.lock:
+            self.open -= 1
+            finished = self.open == 0
+        if finished:
+            self.tracer.finish(self)
+
+    def as_dict(self):
+        root = self.spans[0]
+        end = max(span.start + (span.duration or 0) for span in self.spans)
+        return {'trace_id': self.trace_id, 'name': root.name, 'start': root.start,
+                'duration_ms': round(1000 * (end - root.start), 3), 'spans': [span.as_dict() for span in self.spans]}
+
+
+class RingBufferSink:
+    """ Keep the last max_traces finished traces in memory. """
+
+    def __init__(self, max_traces=100):
+        self.traces = deque(maxlen=max_traces)
+
+    def write(self, trace):
+        self.traces.append(trace.as_dict())
+
+    def get_traces(self):
+        return list(self.traces)
+
+
+class JsonlSink:
+    """ Append each finished trace as one JSON line to a file. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, trace):
+        line = json.dumps(trace.as_dict(), ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding='utf-8') as f:
+                f.write(line)
+
+
+class Tracer:
+    """ Starts sampled traces and child spans. With sample_rate 0 (default) tracing is off. """
+
+    def __init__(self, sample_rate=0.0, sink=None):
+        self.sample_rate = sample_rate
+        self.sink = sink if sink else RingBufferSink()
+        self.traced, self.failed = 0, 0
+
+    def configure(self, sample_rate, sink=None):
+        """ E.g. tracer.configure(0.1, JsonlSink('traces.jsonl')) traces every 10th line. """
+        self.sample_rate = sample_rate
+        if sink:
+            self.sink = sink
+
+    @contextmanager
+    def start_trace(self, name, **attrs):
+        """ Start a trace with its root span, if sampled. Yields the root span, or None if not sampled. """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            yield None
+            return
+        span = Span(Trace(self), name, attrs=attrs)
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def span(self, name, **attrs):
+        """ Context manager for a child span of the current span. Does nothing if there is no current trace. """
+        parent = current_span.get()
+        if parent is None:
+            return no_span
+        return self.child_span(parent, name, attrs)
+
+    @contextmanager
+    def child_span(self, parent, name, attrs):
+        span = Span(parent.trace, name, parent.span_id, attrs)
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def wrap(self, fn, name=None):
+        """ Wrap a function to be run by another thread, e.g. an executor: its span is opened when it runs, in a copy
+        of the current context, the time it waited for a thread is kept as queued_ms. Until then the trace waits for
+        it, unless the wrapper is dropped without running, e.g. by an executor shut down. Returns fn if not traced. """
+        parent = current_span.get()
+        if parent is None:
+            return fn
+        name = name if name else fn.__qualname__
+        trace, submitted = parent.trace, perf_counter()
+        trace.hold()
+        context = contextvars.copy_context()
+
+        def run_in_span(*args, **kwargs):
+            def run():
+                with self.child_span(parent, name, {'queued_ms': round(1000 * (perf_counter() - submitted), 3)}):
+                    release()  # Once only, the span holds the trace open from now on
+                    return fn(*args, **kwargs)
+            return context.run(run)
+        release = weakref.finalize(run_in_span, trace.close_span)
+        release.atexit = False
+        return run_in_span
+
+    def finish(self, trace):
+        """ Write a finished trace to the sink, a failing sink must not break the call handling. """
+        try:
+            self.sink.write(trace)
+            self.traced += 1
+        except Exception as e:
+            self.failed += 1
+            log.warning(f'Writing trace {trace.trace_id} failed: {e}')
+
+
+tracer = Tracer()  # Default tracer, used by all modules, off until configured
+
+
+def traced(name):
+    """ Decorator: run the function within a child span of the current trace, if any. """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if __name__ == "__main__":
+    # Quick example how to use only
+    tracer.configure(1.0)
+    with tracer.start_trace('example.line', type='RING'):
+        with tracer.span('example.step'):
+            pass
+    print(tracer.sink.get_traces())
@@ -2,17 +2,35 @@
 
 # General methods and classes should go here
 
+import atexit
+import json
+import logging
 import os
+import sqlite3
+import threading
+import time
 from abc import abstractmethod
-from datetime import datetime
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+
+logging.basicConfig(level=logging.WARNING)
+log = logging.getLogger(__name__)
 
 
 class Log:
     """ General logger to one|daily file, with possibility to anonymize whatever wished. """
 
-    def __init__(self, file_prefix, log_folder=None, daily=False, anonymize=False):
-        """ Where to log lines, file_prefix is mandatory. If log_folder not given, will use './log/'. """
+    def __init__(self, file_prefix, log_folder=None, daily=False, anonymize=False,
+                 buffered=False, flush_lines=100, flush_sec=1.0, archive=False):
+        """ Where to log lines, file_prefix is mandatory. If log_folder not given, will use './log/'.
+        If buffered, lines are written in batches by a BufferedLogWriter, call close() to flush finally.
+        If archive and daily, the logs before yesterday are compressed in the background at the first line and on
+        each day rollover, see archive_closed_days. Yesterday's is kept plain, lines of it might still be written. """
         self.do_daily = daily
+        self.do_archive = archive and daily
+        self.archive_lock = threading.Lock()
         self.do_anon = anonymize
         self.file_prefix = file_prefix
         if log_folder:
@@ -20,36 +38,425 @@ class Log:
         else:
             self.log_folder = os.path.join(os.path.dirname(__file__), "../log")
         os.makedirs(self.log_folder, exist_ok=True)
+        self.filepath, self.filepath_valid_until = None, 0
+        self.writer = BufferedLogWriter(flush_lines, flush_sec) if buffered else None
 
     def get_log_filepath(self):
-        """ Build the file path, one|daily log to log_folder/file_prefix(-suffix).log. """
+        """ Build the file path, one|daily log to log_folder/file_prefix(-suffix).log. Cached until midnight. """
         if self.do_daily:
-            dt = datetime.today().strftime('%Y%m%d')
-            return os.path.join(self.log_folder, f'{self.file_prefix}-{dt}.log')
+            now = time.time()
+            if now >= self.filepath_valid_until:
+                today = datetime.fromtimestamp(now)
+                dt = today.strftime('%Y%m%d')
+                self.filepath = os.path.join(self.log_folder, f'{self.file_prefix}-{dt}.log')
+                midnight = datetime.combine(today.date() + timedelta(days=1), datetime.min.time())
+                self.filepath_valid_until = midnight.timestamp()
+                if self.do_archive:
+                    threading.Thread(target=self.archive_in_background, daemon=True).start()
+            return self.filepath
         else:
             return os.path.join(self.log_folder, f'{self.file_prefix}.log')
 
+    def write_line(self, line):
+        """ Append a line to the current log file, either buffered or directly. """
+        filepath = self.get_log_filepath()
+        if self.writer:
+            self.writer.write(filepath, line)
+        else:
+            with open(filepath, "a", encoding='utf-8') as f:
+                f.write(line)
+
+    def flush(self):
+        """ Write the lines buffered so far, the log stays buffered. """
+        if self.writer:
+            self.writer.flush()
+
+    def close(self):
+        """ Flush and close a buffered log, later lines are written directly. """
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.close()
+
+    def get_daily_log_files(self):
+        """ Return sorted (YYYYMMDD, log_path, is_archived) of all daily logs of this file_prefix in log_folder. """
+        from logarchive import ARCHIVE_SUFFIX
+        files = []
+        for name in os.listdir(self.log_folder):
+            day = name[len(self.file_prefix) + 1:len(self.file_prefix) + 9]
+            if not name.startswith(self.file_prefix + '-') or not day.isdigit() or len(day) != 8:
+                continue
+            base = f'{self.file_prefix}-{day}.log'
+            if name == base:
+                files.append((day, os.path.join(self.log_folder, base), False))
+            elif name == base + ARCHIVE_SUFFIX:
+                files.append((day, os.path.join(self.log_folder, base), True))
+        return sorted(files)
+
+    def archive_closed_days(self, keep_days=0):
+        """ Compress the daily logs before today (minus keep_days) into blocks with a time index, see logarchive. """
+        from logarchive import compress_log_file
+        self.flush()
+        before = (datetime.today() - timedelta(days=keep_days)).strftime('%Y%m%d')
+        archived = []
+        with self.archive_lock:
+            for day, log_path, is_archived in self.get_daily_log_files():
+                if day < before and not is_archived:
+                    archived.append(compress_log_file(log_path))
+        return archived
+
+    def archive_in_background(self):
+        """ Thread target on day rollover, a failure is logged, it must not stop the logging. """
+        try:
+            archived = self.archive_closed_days(keep_days=1)
+            if archived:
+                log.info(f'Archived {len(archived)} daily log(s) of {self.file_prefix}')
+        except Exception as e:
+            log.error(f'Archiving daily logs of {self.file_prefix} failed: {e}')
+
+    def query_raw_lines(self, start, end):
+        """ Yield the raw lines logged within [start, end), given as datetime or epoch. Only the matching days and,
+        if archived, only the matching blocks are read. """
+        from logarchive import iter_archive_lines, iter_plain_lines
+        start = start.timestamp() if isinstance(start, datetime) else start
+        end = end.timestamp() if isinstance(end, datetime) else end
+        if not self.do_daily:
+            yield from iter_plain_lines(self.get_log_filepath(), start, end)
+            return
+        for day, log_path, is_archived in self.get_daily_log_files():
+            day_start = datetime.strptime(day, '%Y%m%d')
+            if day_start.timestamp() >= end or (day_start + timedelta(days=1)).timestamp() <= start:
+                continue
+            if is_archived:
+                yield from iter_archive_lines(log_path, start, end)
+            else:
+                yield from iter_plain_lines(log_path, start, end)
+
     @abstractmethod
     def log_line(self, line):
         """ Append a line to the log file. To do so use (self.)log_folder, file_prefix, do_daily, do_anon. """
         raise NotImplementedError("log_line not implemented")
 
 
+class BufferedLogWriter:
+    """ Keep the current log file open and write lines in batches by a background thread. The file path is given
+    per line, so lines logged before midnight go into the file of that day, even if written after midnight. """
+
+    def __init__(self, flush_lines=100, flush_sec=1.0):
+        """ Write if flush_lines are buffered, or at the latest after flush_sec. """
+        self.flush_lines = flush_lines
+        self.flush_sec = flush_sec
+        self.lines = []  # List of (filepath, line)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.file, self.filepath = None, None
+        self.closed = False
+        self.thread = threading.Thread(target=self.writer_thread, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, filepath, line):
+        """ Buffer a line, cheap enough for the listener thread. After close, the line is written at once. """
+        with self.lock:
+            self.lines.append((filepath, line))
+            count = len(self.lines)
+            closed = self.closed
+        if closed:
+            self.flush(keep_open=False)
+        elif count >= self.flush_lines:
+            self.wakeup.set()
+
+    def flush(self, keep_open=True):
+        """ Write all buffered lines, switching the file if the path changed, e.g. at midnight. The write lock is
+        held from taking the lines until they are written, so concurrent flushes keep the lines in order. """
+        with self.write_lock:
+            with self.lock:
+                lines, self.lines = self.lines, []
+            try:
+                for filepath, line in lines:
+                    if filepath != self.filepath:
+                        if self.file:
+                            self.file.close()
+                        self.file, self.filepath = None, None
+                        self.file = open(filepath, "a", encoding='utf-8')
+                        self.filepath = filepath
+                    self.file.write(line)
+                if self.file:
+                    self.file.flush()
+            finally:
+                if not keep_open and self.file:
+                    self.file.close()
+                    self.file, self.filepath = None, None
+
+    def writer_thread(self):
+        """ A failing write (e.g. disk full) loses its batch, but must not stop the thread. """
+        while not self.closed:
+            self.wakeup.wait(self.flush_sec)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f'Writing buffered log lines failed, batch lost: {e}')
+
+    def close(self):
+        """ Stop the thread, write the remaining lines and close the file. Lines written later, e.g. by a thread
+        racing with close, are not lost, they are written directly. """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush(keep_open=False)
+
+
 class Caches:
-    """ General temporary caches, like Caches['tellows'][nr] = CallerInfo - or source could be 'revsearch'..
-    Have to be initialized before, then passed to CallerInfo. Not used yet. """
+    """ General caches, like Caches['tellows'][nr] = info - or source could be 'revsearch'.. Used by CallInfo.
+    Each source is a LRU cache with own ttl, "no info" results are cached shorter (negative ttl). Optionally
+    written through to a SQLite file, so the entries survive restarts. Objects have to be JSON serializable. """
+
+    def __init__(self, sources, ttl_sec=3600, negative_ttl_sec=600, max_entries=10000, db_path=None,
+                 normalizer=None, purge_sec=3600):
+        """ ttl_sec and negative_ttl_sec are either one value for all sources, or a dict of source: seconds.
+        Expired entries are purged from the SQLite file when it is opened, and then every purge_sec.
+        With a NumberNormalizer the keys are canonical numbers, so 07191.., +497191.. and 00497191.. share one
+        entry. CallBlocker sets the one of its CallPrefix, if none is given. """
+        self.caches = {source: OrderedDict() for source in sources}  # source: {key: (expires, negative, obj)}
+        self.normalizer = normalizer
+        self.ttl_sec = ttl_sec
+        self.negative_ttl_sec = negative_ttl_sec
+        self.max_entries = max_entries
+        self.stats = {source: {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0} for source in sources}
+        self.lock = threading.RLock()
+        self.purge_sec = purge_sec
+        self.next_purge = 0
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS caches (source TEXT, key TEXT, expires REAL, '
+                            'negative INTEGER, obj TEXT, PRIMARY KEY (source, key))')
+            self.db.commit()
+            self.purge_expired()
+
+    def __getitem__(self, source):
+        if source not in self.caches:
+            raise Exception(f'Source {source} does not exist or was not initialized!')
+        return self.caches[source]
+
+    def __contains__(self, source):
+        return source in self.caches
 
-    def __init__(self, sources):
-        for source in sources:
-            self[source] = dict()
+    def normalize_key(self, key):
+        """ Numbers might be given with spaces or +49 instead of 0049, or without area or country code. """
+        if self.normalizer:
+            return self.normalizer(str(key))
+        return str(key).replace(' ', '').replace('+', '00')
 
-    def add_source_key_obj(self, source, key, obj):
-        self[source][key] = obj
+    def evict(self, source, cache):
+        """ Drop the least recently used entries above max_entries, call with the lock held. """
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+            self.stats[source]['evictions'] += 1
+
+    def get_ttl(self, source, negative):
+        ttl = self.negative_ttl_sec if negative else self.ttl_sec
+        return ttl.get(source, 3600) if isinstance(ttl, dict) else ttl
+
+    def add_source_key_obj(self, source, key, obj, negative=False):
+        """ Cache an object. Set negative if the source had no information, then it expires by negative ttl. """
+        key = self.normalize_key(key)
+        now = time.time()
+        expires = now + self.get_ttl(source, negative)
+        with self.lock:
+            if now >= self.next_purge:
+                self.purge_expired()
+            cache = self[source]
+            cache[key] = (expires, negative, obj)
+            cache.move_to_end(key)
+            self.evict(source, cache)
+            if self.db:
+                self.db.execute('INSERT OR REPLACE INTO caches VALUES (?, ?, ?, ?, ?)',
+                                (source, key, expires, int(negative), json.dumps(obj)))
+                self.db.commit()
 
     def get_source_key_obj(self, source, key):
-        if source not in self:
-            raise Exception(f'Source {source} does not exist or was not initialized!')
-        return self[source][key] if key in self[source] else None
+        """ Return the cached object, or None if not cached or expired. """
+        key = self.normalize_key(key)
+        now = time.time()
+        with self.lock:
+            cache = self[source]
+            entry = cache.get(key)
+            if entry is None and self.db:
+                row = self.db.execute('SELECT expires, negative, obj FROM caches WHERE source = ? AND key = ?',
+                                      (source, key)).fetchone()
+                if row:
+                    entry = (row[0], bool(row[1]), json.loads(row[2]))
+                    cache[key] = entry
+                    self.evict(source, cache)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del cache[key]
+                self.stats[source]['misses'] += 1
+                return None
+            cache.move_to_end(key)
+            self.stats[source]['negative_hits' if entry[1] else 'hits'] += 1
+            return entry[2]
+
+    def purge_expired(self):
+        """ Remove expired entries from memory and the SQLite file. """
+        now = time.time()
+        with self.lock:
+            self.next_purge = now + self.purge_sec
+            for cache in self.caches.values():
+                for key in [key for key, entry in cache.items() if entry[0] <= now]:
+                    del cache[key]
+            if self.db:
+                self.db.execute('DELETE FROM caches WHERE expires <= ?', (now,))
+                self.db.commit()
+
+    def get_stats(self):
+        """ Return hit/miss counters and sizes per source. """
+        with self.lock:
+            return {source: dict(stats, size=len(self.caches[source])) for source, stats in self.stats.items()}
+
+
+class NumberNormalizer:
+    """ Turn a number from call monitor, phonebook or call list into one canonical international form, using
+    the area and country code of the Fritz!Box: 808123, 07191808123, +49 7191 808123 => 00497191808123.
+    Internal numbers like **610 are kept, a trailing * of a prefix entry like 0039* is kept, too.
+    Results are memoized, so normalizing the same number again is one dictionary probe. """
+
+    def __init__(self, area_code, country_code, max_entries=100000):
+        """ area_code like 07191, country_code like 0049, as retrieved by CallPrefix. """
+        self.area_code = area_code
+        self.country_code = country_code
+        self.max_entries = max_entries
+        self.cache = dict()
+
+    def __call__(self, number):
+        return self.normalize(number)
+
+    def normalize(self, number):
+        canonical = self.cache.get(number)
+        if canonical is None:
+            canonical = self.get_canonical(number)
+            if len(self.cache) >= self.max_entries:
+                self.cache.clear()
+            self.cache[number] = canonical
+        return canonical
+
+    def get_canonical(self, number):
+        nr = number.strip()
+        if not nr or nr.startswith('**'):  # CLIR or internal
+            return nr
+        wildcard = '*' if nr.endswith('*') else ''
+        nr = nr.rstrip('*')
+        if nr.startswith('+'):
+            nr = '00' + nr[1:].replace('(0)', '')  # E.g. +49 (0)7191 ..
+        nr = ''.join(c for c in nr if c.isdigit())
+        if not nr:
+            return number
+        if nr.startswith('00'):
+            pass  # International already
+        elif nr.startswith('0'):
+            nr = self.country_code + nr[1:]  # National with area code
+        else:
+            nr = self.country_code + self.area_code[1:] + nr  # Local number of same area network
+        return nr + wildcard
+
+    def normalize_dict(self, number_name_dict):
+        """ Same dict, but keyed by the canonical numbers. """
+        return {self.normalize(number): name for number, name in number_name_dict.items()}
+
+
+NODE_SLOTS = 12  # Per trie node: child per digit 0-9, slot 10 stays empty for non-digits, value number in 11
+VALUE_SLOT = 11
+EMPTY_NODE = array('i', [0] * NODE_SLOTS)
+DIGIT_SLOTS = bytes(i - 48 if 48 <= i <= 57 else 10 for i in range(256))  # For bytes.translate: b'0' => 0
+
+
+class DigitTrie(Mapping):
+    """ Number prefixes like 0039 (from entries like 0039*) mapped to a value, e.g. a name or a CallPrefixRecord.
+    The longest prefix of a number is found in O(length of number), independent of the count of prefixes.
+    Stored compact in one flat array of ints: a node is NODE_SLOTS ints, holding the offsets of its children and
+    the number of its value (index + 1, 0 if none), so a lookup is one array read per digit. Read-only access like
+    a dict by prefix, e.g. trie['0039'], len(trie), iterating the prefixes in sorted order. """
+
+    def __init__(self, prefix_values=None, nodes=None, values=None):
+        """ Empty, from a dict of prefix: value, or from nodes and values as saved before, e.g. by CallPrefixSnapshot,
+        which are read-only views then and copied on the first change. """
+        self.nodes = nodes if nodes is not None else array('i', EMPTY_NODE)  # Root node at offset 0, 0 means none
+        self.values = values if values is not None else []
+        if prefix_values:
+            for prefix, value in prefix_values.items():
+                self.add(prefix, value)
+
+    def add(self, prefix, value):
+        """ Add or replace a prefix, a trailing * is ignored. """
+        prefix = prefix.rstrip('*')
+        if not prefix.isdigit():
+            raise ValueError(f'Prefix {prefix} has to consist of digits')
+        if not isinstance(self.nodes, array):
+            self.nodes, self.values = array('i', self.nodes), list(self.values)
+        nodes, node = self.nodes, 0
+        for slot in prefix.encode().translate(DIGIT_SLOTS):
+            child = nodes[node + slot]
+            if not child:
+                child = nodes[node + slot] = len(nodes)
+                nodes.extend(EMPTY_NODE)
+            node = child
+        if nodes[node + VALUE_SLOT]:
+            self.values[nodes[node + VALUE_SLOT] - 1] = value
+        else:
+            self.values.append(value)
+            nodes[node + VALUE_SLOT] = len(self.values)
+
+    def find_node(self, prefix):
+        """ Offset of the node of prefix, or None if no prefix starts with it. """
+        node = 0
+        for slot in prefix.encode().translate(DIGIT_SLOTS):
+            node = self.nodes[node + slot]
+            if not node:
+                return None
+        return node
+
+    def __getitem__(self, prefix):
+        node = self.find_node(prefix.rstrip('*'))
+        if node is None or not self.nodes[node + VALUE_SLOT]:
+            raise KeyError(prefix)
+        return self.values[self.nodes[node + VALUE_SLOT] - 1]
+
+    def __iter__(self):
+        return (prefix for prefix, _ in self.walk())
+
+    def __len__(self):
+        return len(self.values)
+
+    def get_longest_match(self, number):
+        """ Return (prefix, value) of the longest prefix of number, or None if no prefix matches. Stops at the first
+        non-digit. """
+        nodes, node, match, length = self.nodes, 0, 0, 0
+        for i, slot in enumerate(number.encode().translate(DIGIT_SLOTS)):
+            node = nodes[node + slot]
+            if not node:
+                break
+            if nodes[node + VALUE_SLOT]:
+                match, length = nodes[node + VALUE_SLOT], i + 1
+        return (number[:length], self.values[match - 1]) if match else None
+
+    def walk(self, prefix=''):
+        """ Yield (prefix, value) of all prefixes starting with prefix, e.g. walk('0088'), sorted by prefix. """
+        node = self.find_node(prefix)
+        if node is None:
+            return
+        nodes, values = self.nodes, self.values
+        stack = [(node, prefix)]
+        while stack:
+            node, code = stack.pop()
+            if nodes[node + VALUE_SLOT]:
+                yield code, values[nodes[node + VALUE_SLOT] - 1]
+            stack.extend((nodes[node + digit], code + str(digit)) for digit in range(9, -1, -1)
+                         if nodes[node + digit])
 
 
 def anonymize_number(number):
@@ -59,3 +466,28 @@ def anonymize_number(number):
     else:
         # Not a number or e.g. "unknown" if caller uses CLIR
         return number
+
+
+hour_epochs = dict()  # Cache for datetime_to_epoch, e.g. '16.06.20 12': 1592301600
+
+
+def datetime_to_epoch(dt):
+    """ Convert a datetime 'dd.mm.yy HH:MM:SS' of call monitor or blocker lines, as str or bytes, to seconds since
+    epoch (local time). The begin of each hour is cached, so mostly only minutes and seconds have to be added. """
+    hour = dt[:11]
+    base = hour_epochs.get(hour)
+    if base is None:
+        if len(hour_epochs) > 10000:
+            hour_epochs.clear()
+        base = int(time.mktime((2000 + int(dt[6:8]), int(dt[3:5]), int(dt[0:2]), int(dt[9:11]), 0, 0, 0, 0, -1)))
+        hour_epochs[hour] = base
+    return base + int(dt[12:14]) * 60 + int(dt[15:17])
+
+
+def get_line_epoch(line):
+    """ Return the timestamp of a call monitor or blocker line, as str or bytes, as seconds since epoch, None if it
+    can not be parsed, e.g. for a comment. Used for replays, time indexes and queries of the logs. """
+    try:
+        return datetime_to_epoch(line)
+    except (ValueError, IndexError, OverflowError):
+        return None
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+
+# Offline microbenchmarks of the hot paths, the Fritz!Box and the HTTP providers are faked in-process.
+# Results are saved as JSON, compare them to a previous run to catch regressions before deploying, e.g.:
+#   python3 benchmarks/benchmark.py --compare benchmarks/results/latest.json
+# Exits with 1 if a benchmark got slower than the threshold (default 1.2 = 20% slower).
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import FakeFritzConn, install_fake_providers, get_synthetic_phonebook, AREA_CODE, COUNTRY_CODE, \
+    SPAM_MARKER
+
+from callblocker import CallBlocker, CallBlockerLine
+from callmonitor import CallMonitorLine
+from callprefix import CallPrefix
+from phonebook import Phonebook
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+LATEST_FILE = 'latest.json'
+
+devnull = open(os.devnull, 'w')  # The call blocker prints every line
+
+
+def get_call_monitor_lines(count):
+    """ Mixed call monitor lines, like a day of RING, CALL, CONNECT and DISCONNECT events. """
+    templates = ['01.01.21 10:00:{s:02};RING;{i};0711{n};7321234;SIP0;',
+                 '01.01.21 10:00:{s:02};CALL;{i};11;7321234;0175{n};SIP0;',
+                 '01.01.21 10:00:{s:02};CONNECT;{i};11;0711{n};',
+                 '01.01.21 10:00:{s:02};DISCONNECT;{i};42;']
+    return [templates[i % 4].format(s=i % 60, i=i % 10, n=1000000 + i) + "\n" for i in range(count)]
+
+
+def get_prefix_numbers(count):
+    """ Numbers resolved by CallPrefix: landline, mobile, with country code, abroad and unknown prefixes. """
+    prefixes = ['07191', '030', '0201', '07151', '0175', '0152', COUNTRY_CODE + '711', '0039', '00441534', '09460']
+    return [prefixes[i % len(prefixes)] + str(100000 + i) for i in range(count)]
+
+
+def get_lookup_numbers(numbers, count):
+    """ Lookups of phonebook numbers, half of them written differently (with or without area and country code),
+    plus misses. """
+    known = list(numbers)
+    lookups = []
+    for i in range(count):
+        number = known[(i * 7919) % len(known)]
+        if i % 4 == 1 and number.startswith('0') and not number.startswith('00'):
+            number = COUNTRY_CODE + number[1:]
+        elif i % 4 == 2 and number[0] != '0':
+            number = AREA_CODE + number
+        elif i % 4 == 3:
+            number = '0999' + str(i)  # Miss
+        lookups.append(number)
+    return lookups
+
+
+def get_call_blocker_lines(count):
+    """ Call blocker lines of all methods. """
+    templates = ['01.01.21 10:00:00;WHITELIST;0;07191{n};"Friend";',
+                 '01.01.21 10:00:00;BLOCK;3;0781{n};"Spam, Fake City";8;12;42;',
+                 '01.01.21 10:00:00;PASS;3;0711{n};"Meier, Backnang";5;0;42;',
+                 '01.01.21 10:00:00;PASS;0;;ANON;']
+    return [templates[i % 4].format(n=1000000 + i) + "\n" for i in range(count)]
+
+
+def bench_callmonitor_parse(size):
+    return CallMonitorLine, get_call_monitor_lines(size)
+
+
+def bench_callmonitor_anonymize(size):
+    return CallMonitorLine.anonymize, get_call_monitor_lines(size)
+
+
+def bench_callprefix_get_prefix_dict(size):
+    cp = CallPrefix(fc=FakeFritzConn())
+    return cp.get_prefix_dict, get_prefix_numbers(size)
+
+
+def bench_callprefix_get_prefix_arrays(size):
+    """ Batches of 1000 numbers per op, vectorized if NumPy is installed. """
+    cp = CallPrefix(fc=FakeFritzConn())
+    numbers = get_prefix_numbers(size)
+    return cp.get_prefix_arrays, [numbers[i:i + 1000] for i in range(0, len(numbers), 1000)]
+
+
+def bench_callprefix_init(size):
+    """ Construction, the first one compiles the snapshot if outdated, the timed ones map it. """
+    fc = FakeFritzConn()
+    CallPrefix(fc=fc)
+    return lambda i: CallPrefix(fc=fc), range(size)
+
+
+def bench_phonebook_get_name_for_number_in_dict(size):
+    numbers = get_synthetic_phonebook(10 * size)
+    pb = Phonebook(fc=FakeFritzConn())
+
+    def lookup(number):
+        return pb.get_name_for_number_in_dict(number, numbers, area_code=AREA_CODE, country_code=COUNTRY_CODE)
+    return lookup, get_lookup_numbers(numbers, size)
+
+
+def bench_phonebook_refresh(size):
+    """ Download and parse a changed phonebook with 10 * size contacts, per call. """
+    fc = FakeFritzConn({0: get_synthetic_phonebook(10 * size)})
+    pb = Phonebook(fc=fc)
+    return lambda pb_id: pb.get_all_numbers_if_changed(pb_id), [0]
+
+
+def bench_phonebook_refresh_unchanged(size):
+    """ Check a phonebook with 10 * size contacts for changes, it is unchanged. """
+    fc = FakeFritzConn({0: get_synthetic_phonebook(10 * size)})
+    pb = Phonebook(fc=fc)
+    marker, _ = pb.get_all_numbers_if_changed(0)
+    return lambda pb_id: pb.get_all_numbers_if_changed(pb_id, marker), [0]
+
+
+def bench_callblocker_line_roundtrip(size):
+    return lambda raw_line: (str(CallBlockerLine(raw_line)), CallBlockerLine.anonymize(raw_line)), \
+        get_call_blocker_lines(size)
+
+
+def bench_callblocker_decision(size):
+    """ Full decision per call monitor line: whitelisted, blacklisted, illegal prefix, unknown rated online (fake)
+    and spam, which gets blocked once and is blacklisted then. """
+    whitelist = get_synthetic_phonebook(10 * size, seed=1, prefix='Friend')
+    blacklist = get_synthetic_phonebook(size, seed=2, prefix='Spam')
+    fc = FakeFritzConn({0: whitelist, 1: blacklist, 2: dict()})
+    with contextlib.redirect_stdout(devnull):
+        cb = CallBlocker(fc=fc, whitelist_pbids=[0], blacklist_pbids=[1, 2], blocklist_pbid=2)
+    callers = [list(whitelist)[0], list(blacklist)[0], '09460123456', '0711555' + '1234', SPAM_MARKER + '1234567']
+    lines = [f'01.01.21 10:00:00;RING;{i % 10};{callers[i % len(callers)]};7321234;SIP0;' + "\n" for i in range(size)]
+
+    def decide(raw_line):
+        with contextlib.redirect_stdout(devnull):
+            cb.parse_and_examine_line(raw_line)
+    return decide, lines
+
+
+# Name: (setup returning a function and its inputs, size of the inputs)
+BENCHMARKS = {
+    'callmonitor.parse': (bench_callmonitor_parse, 10000),
+    'callmonitor.anonymize': (bench_callmonitor_anonymize, 10000),
+    'callprefix.get_prefix_dict': (bench_callprefix_get_prefix_dict, 10000),
+    'callprefix.get_prefix_arrays_1000': (bench_callprefix_get_prefix_arrays, 100000),
+    'callprefix.init': (bench_callprefix_init, 100),
+    'phonebook.get_name_for_number_in_dict': (bench_phonebook_get_name_for_number_in_dict, 10000),
+    'phonebook.refresh': (bench_phonebook_refresh, 1000),
+    'phonebook.refresh_unchanged': (bench_phonebook_refresh_unchanged, 1000),
+    'callblocker.line_roundtrip': (bench_callblocker_line_roundtrip, 10000),
+    'callblocker.decision': (bench_callblocker_decision, 1000),
+}
+
+
+def run_benchmark(setup, size, repeat):
+    """ Time the function over all inputs repeat times, the best run is the least disturbed one. """
+    fn, inputs = setup(size)
+    per_op = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for item in inputs:
+            fn(item)
+        per_op.append((perf_counter() - start) / len(inputs))
+    return {'size': size, 'ops': len(inputs), 'repeat': repeat,
+            'best_us': round(1e6 * min(per_op), 3), 'median_us': round(1e6 * statistics.median(per_op), 3)}
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run_all(names, repeat, scale):
+    results = {'created': datetime.now().isoformat(timespec='seconds'), 'commit': get_git_commit(),
+               'python': platform.python_version(), 'machine': platform.machine(), 'scale': scale, 'benchmarks': {}}
+    for name in names:
+        setup, size = BENCHMARKS[name]
+        results['benchmarks'][name] = res = run_benchmark(setup, max(1, int(size * scale)), repeat)
+        print(f'{name:45} {res["best_us"]:12.3f} us/op (median {res["median_us"]:.3f}, {res["ops"]} ops)')
+    return results
+
+
+def compare(results, previous, threshold):
+    """ Print the ratio to the previous run per benchmark, return the names of the ones slower than threshold. """
+    regressions = []
+    print(f'\nCompared to {previous.get("created")} ({previous.get("commit")}):')
+    for name, res in results['benchmarks'].items():
+        old = previous['benchmarks'].get(name)
+        if not old or not old['best_us']:
+            print(f'{name:45} new')
+            continue
+        ratio = res['best_us'] / old['best_us']
+        flag = ''
+        if ratio > threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / threshold:
+            flag = ' faster'
+        print(f'{name:45} {old["best_us"]:12.3f} -> {res["best_us"]:12.3f} us/op x{ratio:.2f}{flag}')
+    return regressions
+
+
+def save(results, output):
+    """ Save the results. If saved to the results folder, also as its latest.json, which is the default to compare
+    to. An ad-hoc run with --output elsewhere leaves that baseline alone. """
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    latest = os.path.join(RESULTS_FOLDER, LATEST_FILE)
+    if os.path.dirname(os.path.abspath(output)) == os.path.abspath(RESULTS_FOLDER) \
+            and os.path.abspath(output) != os.path.abspath(latest):
+        shutil.copyfile(output, latest)
+    print(f'\nResults saved to {output}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline microbenchmarks of a1fbox hot paths.')
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run, default all: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the best is reported')
+    parser.add_argument('--scale', type=float, default=1.0, help='scale the input sizes, e.g. 0.1 for a quick run')
+    parser.add_argument('--output', help='JSON file for the results, default results/<timestamp>.json')
+    parser.add_argument('--compare', help='JSON file of a previous run, e.g. results/latest.json')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slower by this factor is a regression')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(unknown)}')
+    install_fake_providers()
+    # Read before saving, as latest.json is overwritten by a run saved to the results folder
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+    results = run_all(args.names if args.names else list(BENCHMARKS), args.repeat, args.scale)
+    save(results, args.output if args.output else
+         os.path.join(RESULTS_FOLDER, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json'))
+    if previous and compare(results, previous, args.threshold):
+        sys.exit(1)
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+# In-process fakes for the Fritz!Box and the HTTP providers, so the hot paths run offline and reproducibly.
+# They answer just enough of the SOAP actions and HTTP requests, the modules under test run unchanged.
+
+import os
+import random
+import sys
+from xml.sax.saxutils import escape
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'a1fbox'))
+import callblocker
+import callinfo
+from ratelimit import RateLimiter, DEFAULT_RATES
+
+AREA_CODE = '07191'
+COUNTRY_CODE = '0049'
+SPAM_MARKER = '0781'  # Numbers containing this are rated as spam by the fake tellows
+PHONEBOOK_TIMESTAMP = 1600000000
+
+
+def get_phonebook_xml(number_name_dict, timestamp=PHONEBOOK_TIMESTAMP):
+    """ Phonebook in the XML format the Fritzbox serves for download. """
+    contacts = ''.join(f'<contact><category>0</category><person><realName>{escape(name)}</realName></person>'
+                       f'<telephony nid="1"><number type="home" prio="1" id="0">{escape(number)}</number></telephony>'
+                       f'<uniqueid>{i}</uniqueid></contact>'
+                       for i, (number, name) in enumerate(number_name_dict.items()))
+    return (f'<?xml version="1.0" encoding="utf-8"?><phonebooks><phonebook name="Fake">'
+            f'<timestamp>{timestamp}</timestamp>{contacts}</phonebook></phonebooks>')
+
+
+def get_synthetic_phonebook(size, seed=0, prefix='Contact'):
+    """ A number-name-dict with size numbers, mixed like real phonebooks: local numbers without area code,
+    national numbers with area code, mobile and some with country code. """
+    rnd = random.Random(seed)
+    numbers = dict()
+    while len(numbers) < size:
+        kind = rnd.random()
+        if kind < 0.3:
+            number = str(rnd.randint(10000, 9999999))  # Same area, without area code
+        elif kind < 0.7:
+            number = '0' + str(rnd.randint(2000, 9999)) + str(rnd.randint(10000, 999999))
+        elif kind < 0.9:
+            number = '017' + str(rnd.randint(10000000, 99999999))
+        else:
+            number = COUNTRY_CODE + str(rnd.randint(2000, 9999)) + str(rnd.randint(10000, 999999))
+        numbers[number] = f'{prefix} {len(numbers)}'
+    return numbers
+
+
+class FakeResponse:
+
+    def __init__(self, text='', obj=None):
+        self.text = text
+        self.obj = obj
+        self.headers = {'Content-type': 'text/xml'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.obj
+
+
+class FakeSession:
+    """ Serves the phonebook downloads of FakeFritzConn. Like the Fritzbox, a phonebook is served without
+    contacts if the timestamp parameter equals its timestamp. """
+
+    def __init__(self, phonebooks):
+        self.phonebooks = phonebooks
+
+    def get(self, url, timeout=None, **kwargs):
+        url, _, query = url.partition('?')
+        pb_id = int(url.rsplit('/', 1)[1])
+        if query == f'timestamp={PHONEBOOK_TIMESTAMP}':
+            return FakeResponse(get_phonebook_xml(dict()))
+        return FakeResponse(get_phonebook_xml(self.phonebooks[pb_id]))
+
+
+class FakeFritzConn:
+    """ Answers the SOAP actions used by CallPrefix, Phonebook and CallBlocker. Phonebooks are number-name-dicts,
+    SetPhonebookEntry is accepted but does not change them. """
+
+    modelname = 'FRITZ!Box Fake'
+    system_version = '7.29'
+    timeout = None
+
+    def __init__(self, phonebooks=None):
+        self.phonebooks = phonebooks if phonebooks else {0: dict()}
+        self.session = FakeSession(self.phonebooks)
+        self.actions = 0
+
+    def call_action(self, service, actionname, **kwargs):
+        self.actions += 1
+        if actionname == 'X_AVM-DE_GetVoIPCommonAreaCode':
+            return {'NewX_AVM-DE_OKZPrefix': AREA_CODE[0], 'NewX_AVM-DE_OKZ': AREA_CODE[1:]}
+        if actionname == 'X_AVM-DE_GetVoIPCommonCountryCode':
+            return {'NewX_AVM-DE_LKZPrefix': COUNTRY_CODE[:2], 'NewX_AVM-DE_LKZ': COUNTRY_CODE[2:]}
+        if actionname == 'GetPhonebookList':
+            return {'NewPhonebookList': ','.join(str(pb_id) for pb_id in self.phonebooks)}
+        if actionname == 'GetPhonebook':
+            pb_id = kwargs['NewPhonebookId']
+            return {'NewPhonebookName': f'Fake {pb_id}', 'NewPhonebookURL': f'http://fake/phonebook/{pb_id}',
+                    'NewPhonebookExtraID': ''}
+        return dict()
+
+
+class FakeRequests:
+    """ Replaces the requests module in callinfo: tellows and DasOertliche answer at once. """
+
+    exceptions = requests.exceptions
+
+    def __init__(self):
+        self.requests = 0
+
+    def get(self, url, timeout=None, **kwargs):
+        self.requests += 1
+        if 'tellows' in url:
+            spam = SPAM_MARKER in url
+            return FakeResponse(obj={'tellows': {'score': 8 if spam else 5, 'comments': 12 if spam else 0,
+                                                 'searches': 42, 'location': 'Fake City'}})
+        return FakeResponse("var x = 1; generic: {city: 'Backnang', name: 'Meier'}; var y = 2;")
+
+
+def install_fake_providers():
+    """ Route the online lookups to FakeRequests, without rate limits and without posting notifications. """
+    fake_requests = FakeRequests()
+    callinfo.requests = fake_requests
+    callinfo.rate_limiter = RateLimiter(rates={provider: (10 ** 9, 1, 10 ** 9) for provider in DEFAULT_RATES},
+                                        shared=False)
+    callblocker.TELEGRAM_BOT_URL = ''
+    return fake_requests
@@ -14,7 +14,7 @@ from config import FRITZ_IP_ADDRESS
 if __name__ == "__main__":
     print("To stop enter '!' (exclamation mark) followed by ENTER key..")
 
-    cm_log = CallMonitorLog(daily=True, anonymize=False)
+    cm_log = CallMonitorLog(daily=True, anonymize=False, buffered=True)
     cm = CallMonitor(host=FRITZ_IP_ADDRESS, logger=cm_log.log_line)
 
     key = ""
@@ -11,24 +11,45 @@
 # To see some action e.g. call from intern phone 1 to phone 2,
 # or use your mobile phone to call the landline. This will print and log the calls.
 
-from a1fbox.fritzconn import FritzConn
-from a1fbox.callmonitor import CallMonitor, CallMonitorLog
-from a1fbox.callblocker import CallBlocker, CallBlockerLog
+import os
+import sys
+
+# The modules import each other flat, so import them the same way here. Imported as a1fbox.callinfo as well,
+# a module would be loaded twice, e.g. with its own metrics registry, executor and rate limiters.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'a1fbox'))
+from fritzconn import FritzConn
+from callmonitor import CallMonitor, CallMonitorLog
+from callblocker import CallBlocker, CallBlockerLog
+from callinfo import get_default_caches
+from metrics import registry
 
 if __name__ == "__main__":
 
     # Initialize by using parameters from config file
     fritzconn = FritzConn()
 
+    # Optional: serve metrics (lines, verdicts, latencies) locally, e.g. for Prometheus or: curl localhost:9123/metrics
+    registry.start_server(port=9123)
+
     # There are two loggers. cm_log logs the raw line from call monitor of Fritzbox,
     # cb_log logs the actions of the call blocker. The CallMonitor uses the
     # CallBlocker and it's parse_and_examine_line method to examine the raw line.
 
     # Idea: could also define which rating method should be used?
 
-    cb_log = CallBlockerLog(daily=True, anonymize=False)
+    # Results of the online lookups are cached in a SQLite file, so repeated calls do not query again
+    cb_log = CallBlockerLog(daily=True, anonymize=False, buffered=True, archive=True)
+    caches = get_default_caches(db_path=cb_log.log_folder + '/callinfo.sqlite')
     cb = CallBlocker(fc=fritzconn, whitelist_pbids=[0], blacklist_pbids=[1, 2], blocklist_pbid=2,
-                     blockname_prefix='[Spam] ', min_score=6, min_comments=2, logger=cb_log.log_line)
+                     blockname_prefix='[Spam] ', min_score=6, min_comments=2, logger=cb_log.log_line, caches=caches)
 
-    cm_log = CallMonitorLog(daily=True, anonymize=False)
+    cm_log = CallMonitorLog(daily=True, anonymize=False, buffered=True, archive=True)
     cm = CallMonitor(host=fritzconn.address, logger=cm_log.log_line, parser=cb.parse_and_examine_line)
+
+    print("To stop enter '!' (exclamation mark) followed by ENTER key..")
+    key = ""
+    while key != "!":
+        key = input()
+
+    cm.stop()
+    cb.stop()